@@ -0,0 +1,487 @@
+
+from compiled_model import FIRST_STAGE_PATH, CascadeStage, CompiledModel
+from detector import Detector
+from dip import dip
+from parameters import Prms
+from pipelines import Pipelines
+from streams import FrameReader
+from telemetry import Telemetry
+from tracker import Tracker
+
+import argparse
+import cv2
+import glob
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from scipy.ndimage import label
+
+#----------
+# Globals
+#----------
+
+test_images = '../test_images/test*.jpg'
+test_video = '../test_video.mp4'
+train_images = '../dataset/vehicles/GTI_Far/*.png'
+results_dir = '../benchmarks'
+
+#------------
+# Helpers
+#------------
+
+def _git_commit():
+    '''Returns the current git commit to tag the results with'''
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _read_video_frames(path, max_frames):
+    '''Returns up to max_frames RGB frames of a video'''
+
+    frames = []
+    reader = FrameReader(path)
+    for frame in reader:
+        if len(frames) >= max_frames:
+            break
+        frames.append(frame)
+    reader.close()
+    return frames
+
+def _measure(fn, inputs, repeat):
+    '''
+    Calls fn on each input repeat times and returns the mean time per call
+    in ms, the peak traced memory of a single call in MB and the outputs of
+    the last round
+    '''
+
+    # Warm up on the first input so that lazy initialization is not timed
+    fn(inputs[0])
+
+    # Time without tracing the memory, which slows the allocations down
+    t = time.time()
+    for _ in range(repeat):
+        outputs = [fn(x) for x in inputs]
+    elapsed = time.time() - t
+
+    # Trace the peak memory of a single call
+    tracemalloc.start()
+    fn(inputs[0])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = repeat * len(inputs)
+    return 1000 * elapsed / calls, peak / 2**20, outputs
+
+def _result(ms_per_call, peak_mb, calls, windows=None):
+    '''Returns a benchmark result record'''
+
+    result = {'ms_per_call': round(ms_per_call, 3),
+              'calls': calls,
+              'peak_mem_mb': round(peak_mb, 2)}
+    if windows is not None:
+        result['windows_per_call'] = windows
+        result['windows_per_sec'] = round(1000 * windows / max(ms_per_call, 1e-9), 1)
+    return result
+
+#-------------
+# Benchmarks
+#-------------
+
+def bench_find_cars(detector, images, repeat):
+    '''Times dip.find_cars for each of the FAR, MID and NEAR scales'''
+
+    results = OrderedDict()
+    for name, field in (('far', Prms.FAR), ('mid', Prms.MID), ('near', Prms.NEAR)):
+        def find_windows(image):
+            return dip.find_windows(image,
+                                    Prms.Y_START[field],
+                                    Prms.Y_STOP[field],
+                                    Prms.SCALE[field],
+                                    detector.model, None,
+                                    Prms.HOG_CHANNEL,
+                                    Prms.ORIENT,
+                                    Prms.PIX_PER_CELL,
+                                    Prms.CELL_PER_BLOCK,
+                                    Prms.SPATIAL_SIZE,
+                                    Prms.N_BINS,
+                                    Prms.X_START[field])
+
+        ms, peak, outputs = _measure(find_windows, images, repeat)
+        windows = len(outputs[0][0])
+        results['find_cars_' + name] = _result(ms, peak, repeat * len(images), windows)
+    return results
+
+def _first_stage():
+    '''Returns the trained first stage of the cascade, whether Prms.CASCADE enables it or not'''
+
+    if not os.path.exists(FIRST_STAGE_PATH):
+        return None
+    return CascadeStage.load()
+
+def check_cascade(model, first_stage, images, frames):
+    '''
+    Compares the vehicles found with the first stage of the cascade against a
+    full search: the boxes of each test image after the heat threshold of the
+    -i command and the boxes of each video frame after the rolling heat.
+    Returns the share of the images and frames with unchanged boxes and the
+    share of the hits of the full search that the cascade keeps, along with
+    whether all the boxes are unchanged
+    '''
+
+    unchanged = 0
+    hits = [0, 0]
+    for image in images:
+        outputs = [Pipelines.locate_image(image, model, None, stage) for stage in (None, first_stage)]
+        unchanged += sorted(outputs[0][0]) == sorted(outputs[1][0])
+        hits[0] += outputs[0][2]
+        hits[1] += outputs[1][2]
+
+    # A session for each, the rolling heat depends on the previous frames
+    full = Detector(svc=model, track_every=1)
+    cascade = Detector(svc=model, track_every=1)
+    cascade.first_stage = first_stage
+    for frame in frames:
+        records = [detector.process_detections(frame) for detector in (full, cascade)]
+        unchanged += sorted(records[0]['boxes']) == sorted(records[1]['boxes'])
+        for i, record in enumerate(records):
+            hits[i] += sum(record['hits_scale_{}'.format(scale)] for scale in Prms.SCALE)
+
+    share = unchanged / max(len(images) + len(frames), 1)
+    return share, hits[1] / max(hits[0], 1), share == 1
+
+def bench_cascade(detector, images, frames, repeat):
+    '''
+    Times dip.find_cars_multiscale without and with the first stage of the
+    cascade and reports the share of the windows that the first stage rejects,
+    the time per frame of the first stage and of the hog, the share of the
+    time that it saves and whether it finds the same vehicles
+    '''
+
+    first_stage = _first_stage()
+    if first_stage is None:
+        print('>>> No first stage of the cascade has been trained, skipping its benchmark')
+        return {}
+
+    results = OrderedDict()
+    for name, stage in (('find_cars_multiscale', None), ('find_cars_cascade', first_stage)):
+        # Count the windows and the rejected windows of each call
+        telemetry = Telemetry()
+        def find_cars_multiscale(image):
+            telemetry.begin_frame(0)
+            output = dip.find_cars_multiscale(image, detector.model, None,
+                                              telemetry=telemetry, first_stage=stage)
+            telemetry.end_frame()
+            return output
+
+        ms, peak, outputs = _measure(find_cars_multiscale, images, repeat)
+        summary = telemetry.summary()
+        results[name] = _result(ms, peak, repeat * len(images), int(summary['windows']))
+        results[name]['hog_ms'] = round(summary.get('hog_ms', 0), 3)
+        if stage is not None:
+            results[name]['cascade_ms'] = round(summary.get('cascade_ms', 0), 3)
+            results[name]['rejection_rate'] = round(summary.get('rejected', 0) / max(summary['windows'], 1), 4)
+
+            # The saving is measured against the full search, not derived from the rejected windows
+            full = results['find_cars_multiscale']
+            results[name]['saving'] = round(1 - ms / max(full['ms_per_call'], 1e-9), 4)
+            results[name]['hog_saving'] = round(1 - results[name]['hog_ms'] / max(full['hog_ms'], 1e-9), 4)
+
+            # The rejected windows must not change the vehicles that are found
+            unchanged, hits_kept, ok = check_cascade(detector.model, stage, images, frames)
+            results[name]['boxes_unchanged'] = round(unchanged, 4)
+            results[name]['hits_kept'] = round(hits_kept, 4)
+    return results
+
+def check_hog_backend(images, backend='numpy', tolerance=1e-5):
+    '''
+    Compares the hog features of a backend with skimage on the search area
+    of each image and on 64x64 windows of it, and returns the largest
+    absolute difference along with whether it is within the tolerance
+    '''
+
+    max_diff = 0.
+    for image in images:
+        ctrans = dip.convertImageForColorspace(image[min(Prms.Y_START):max(Prms.Y_STOP)],
+                                               Prms.COLORSPACE)
+        for area in (ctrans, ctrans[:64,:64], cv2.resize(ctrans, (64, 64))):
+            reference = dip.get_hog_channels(area, Prms.ORIENT, Prms.PIX_PER_CELL,
+                                             Prms.CELL_PER_BLOCK, backend='skimage')
+            features = dip.get_hog_channels(area, Prms.ORIENT, Prms.PIX_PER_CELL,
+                                            Prms.CELL_PER_BLOCK, backend=backend)
+            for expected, actual in zip(reference, features):
+                if expected.shape != actual.shape:
+                    return np.inf, False
+                max_diff = max(max_diff, float(np.max(np.abs(expected - actual))))
+    return max_diff, max_diff <= tolerance
+
+def bench_hog(images, repeat):
+    '''Times the hog features of the search area of the images with each backend'''
+
+    results = OrderedDict()
+    for backend in ('skimage', 'numpy'):
+        def get_hog_channels(image):
+            ctrans = dip.convertImageForColorspace(image[min(Prms.Y_START):max(Prms.Y_STOP)],
+                                                   Prms.COLORSPACE)
+            return dip.get_hog_channels(ctrans, Prms.ORIENT, Prms.PIX_PER_CELL,
+                                        Prms.CELL_PER_BLOCK, feature_vec=False, backend=backend)
+
+        ms, peak, outputs = _measure(get_hog_channels, images, repeat)
+        results['hog_' + backend] = _result(ms, peak, repeat * len(images))
+        if backend != 'skimage':
+            results['hog_' + backend]['max_abs_diff'], ok = check_hog_backend(images[:1], backend)
+    return results
+
+def bench_search_windows(detector, images, repeat):
+    '''Times dip.search_windows over the sliding windows of the debug pipeline'''
+
+    windows = dip.slide_window(images[0],
+                               x_start_stop=[None, None],
+                               y_start_stop=[Prms.Y_START[Prms.MID], Prms.Y_STOP[Prms.MID]],
+                               xy_window=Prms.XY_WINDOW,
+                               xy_overlap=Prms.XY_OVERLAP)
+
+    def search_windows(image):
+        return dip.search_windows(image, windows, detector.model, None,
+                                  color_space=Prms.COLORSPACE,
+                                  spatial_size=Prms.SPATIAL_SIZE,
+                                  hist_bins=Prms.N_BINS,
+                                  orient=Prms.ORIENT,
+                                  pix_per_cell=Prms.PIX_PER_CELL,
+                                  cell_per_block=Prms.CELL_PER_BLOCK,
+                                  hog_channel=Prms.HOG_CHANNEL,
+                                  spatial_feat=Prms.SPATIAL_FEAT,
+                                  hist_feat=Prms.HIST_FEAT,
+                                  hog_feat=Prms.HOG_FEAT)
+
+    ms, peak, outputs = _measure(search_windows, images[:1], repeat)
+    return {'search_windows': _result(ms, peak, repeat, len(windows))}
+
+def bench_extract_features(paths, repeat):
+    '''Times dip.extract_features on training images, including the flipped copy'''
+
+    def extract_features(path):
+        return dip.extract_features([path], color_space=Prms.COLORSPACE,
+                                    spatial_size=Prms.SPATIAL_SIZE,
+                                    hist_bins=Prms.N_BINS,
+                                    orient=Prms.ORIENT,
+                                    pix_per_cell=Prms.PIX_PER_CELL,
+                                    cell_per_block=Prms.CELL_PER_BLOCK,
+                                    hog_channel=Prms.HOG_CHANNEL,
+                                    spatial_feat=Prms.SPATIAL_FEAT,
+                                    hist_feat=Prms.HIST_FEAT,
+                                    hog_feat=Prms.HOG_FEAT)
+
+    ms, peak, outputs = _measure(extract_features, paths, repeat)
+    return {'extract_features': _result(ms, peak, repeat * len(paths))}
+
+def bench_heatmap(detector, images, repeat):
+    '''Times add_heat, heatmap, label and draw_labeled_bboxes on the boxes of a window of frames'''
+
+    # Use the detections of all the images repeated as the boxes of a window of frames
+    box_list = []
+    for image in images:
+        box_list += detector.detect(image)[0]
+    box_list = box_list * Prms.HEAT_WINDOW
+
+    results = OrderedDict()
+    ms, peak, outputs = _measure(lambda image: dip.add_heat(np.zeros(image.shape[:2]), box_list),
+                                 images[:1], repeat)
+    results['add_heat'] = _result(ms, peak, repeat)
+
+    ms, peak, outputs = _measure(lambda image: dip.heatmap(image.shape, box_list,
+                                                           Prms.VIDEO_THRESHOLD),
+                                 images[:1], repeat)
+    results['heatmap'] = _result(ms, peak, repeat)
+
+    heatmap = outputs[0]
+    ms, peak, outputs = _measure(lambda image: label(heatmap), images[:1], repeat)
+    results['label'] = _result(ms, peak, repeat)
+
+    labels = outputs[0]
+    ms, peak, outputs = _measure(lambda image: dip.draw_labeled_bboxes(np.copy(image), labels),
+                                 images[:1], repeat)
+    results['draw_labeled_bboxes'] = _result(ms, peak, repeat)
+    return results
+
+def bench_video_pipeline(frames):
+    '''Times the full video pipeline of a detection session on the video frames'''
+
+    detector = Detector()
+    ms, peak, outputs = _measure(detector.process_frame, frames, 1)
+    return {'video_pipeline': _result(ms, peak, len(frames))}
+
+def check_tracking(frames, every=5, min_agreement=0.95):
+    '''
+    Compares the vehicles of the video frames found with tracking between the
+    full searches every few frames against a full search of every frame. A
+    frame agrees when both find the same number of vehicles and every box of
+    the full search overlaps a tracked box by half its union. Returns the share
+    of the frames that agree along with whether it reaches min_agreement
+    '''
+
+    full = [Detector(track_every=1).process_detections, []]
+    tracked = [Detector(track_every=every).process_detections, []]
+    for frame in frames:
+        for process, records in (full, tracked):
+            records.append(process(frame)['boxes'])
+
+    agree = 0
+    for expected, actual in zip(full[1], tracked[1]):
+        if len(expected) == len(actual) and \
+           all(max(Tracker._overlap(box, other) for other in actual) >= 0.5 for box in expected):
+            agree += 1
+    agreement = agree / max(len(frames), 1)
+    return agreement, agreement >= min_agreement
+
+def bench_tracking(frames, every=5):
+    '''Times the video pipeline with tracking between the full searches every few frames'''
+
+    detector = Detector(track_every=every)
+    ms, peak, outputs = _measure(detector.process_frame, frames, 1)
+    result = _result(ms, peak, len(frames))
+    result['agreement'], ok = check_tracking(frames, every)
+    return {'video_pipeline_track_{}'.format(every): result}
+
+def bench_model_load(detector, repeat):
+    '''Times loading the compiled model artifact of the detection session'''
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'linear_model.bin')
+        detector.model.save(path)
+        ms, peak, outputs = _measure(CompiledModel.load, [path], repeat)
+        del outputs
+    return {'model_load': _result(ms, peak, repeat)}
+
+#-------------
+# Reporting
+#-------------
+
+def _print_results(results):
+    print('{:<24} {:>12} {:>14} {:>12}'.format('benchmark', 'ms/call', 'windows/sec', 'peak MB'))
+    for name, result in results.items():
+        print('{:<24} {:>12.2f} {:>14} {:>12.2f}'.format(name, result['ms_per_call'],
+                                                         result.get('windows_per_sec', '-'),
+                                                         result['peak_mem_mb']))
+    for name, result in results.items():
+        if 'max_abs_diff' in result:
+            print('>>> {} differs from skimage by at most {:.3g}'.format(name, result['max_abs_diff']))
+        if 'agreement' in result:
+            print('>>> {} agrees with the full search on {:.1f}% of the frames'.format(
+                  name, 100 * result['agreement']))
+        if 'rejection_rate' in result:
+            print('>>> The first stage of {} rejects {:.1f}% of the windows'.format(
+                  name, 100 * result['rejection_rate']))
+        if 'hits_kept' in result:
+            print('>>> {} keeps {:.1f}% of the hits and the boxes of {:.1f}% of the images and frames'.format(
+                  name, 100 * result['hits_kept'], 100 * result['boxes_unchanged']))
+        if 'saving' in result:
+            print('>>> {} saves {:.1f}% of the time per frame and {:.1f}% of the hog time ({:.2f} ms), '
+                  'its first stage takes {:.2f} ms'.format(name, 100 * result['saving'], 100 * result['hog_saving'],
+                                                           result['hog_ms'], result['cascade_ms']))
+
+def _print_comparison(results, baseline):
+    '''Prints the change of the time per call against the results of another commit'''
+
+    print('>>> Comparison with commit', baseline['commit'])
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['ms_per_call']
+        after = result['ms_per_call']
+        print('{:<24} {:>10.2f} -> {:>10.2f} ms ({:+.1f}%)'.format(
+              name, before, after, 100 * (after - before) / max(before, 1e-9)))
+
+#--------
+# Main
+#--------
+
+def run(repeat=3, n_frames=30, n_train=50):
+    '''Runs all the benchmarks and returns the results record'''
+
+    detector = Detector()
+    images = [dip.read_image(path) for path in sorted(glob.glob(test_images))]
+    frames = _read_video_frames(test_video, n_frames)
+    paths = sorted(glob.glob(train_images))[:n_train]
+
+    results = OrderedDict()
+    results.update(bench_find_cars(detector, images, repeat))
+    results.update(bench_hog(images, repeat))
+    results.update(bench_cascade(detector, images, frames, repeat))
+    results.update(bench_search_windows(detector, images, repeat))
+    results.update(bench_extract_features(paths, repeat))
+    results.update(bench_heatmap(detector, images, repeat))
+    results.update(bench_video_pipeline(frames))
+    results.update(bench_tracking(frames))
+    results.update(bench_model_load(detector, repeat))
+
+    return {'commit': _git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the vehicle detection hot paths')
+    parser.add_argument('-o', '--output', help='JSON file for the results '
+                        '(default: ../benchmarks/<commit>.json)')
+    parser.add_argument('-c', '--compare', help='JSON results of another commit to compare with')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Rounds for each benchmark')
+    parser.add_argument('--frames', type=int, default=30, help='Video frames for the pipeline')
+    parser.add_argument('--check-hog', action='store_true',
+                        help='Only check the hog backend of Prms against skimage on the test images')
+    parser.add_argument('--check-track', type=int, nargs='?', const=5, metavar='N',
+                        help='Only check the video detections with tracking between full searches '
+                             'every N frames against a full search of every frame')
+    parser.add_argument('--check-cascade', action='store_true',
+                        help='Only check that the first stage of the cascade keeps the vehicles '
+                             'of a full search of the test images and video frames')
+    args = parser.parse_args()
+
+    if args.check_cascade:
+        first_stage = _first_stage()
+        if first_stage is None:
+            print('>>> No first stage of the cascade has been trained')
+            sys.exit(1)
+        images = [dip.read_image(path) for path in sorted(glob.glob(test_images))]
+        unchanged, hits_kept, ok = check_cascade(Detector().model, first_stage, images,
+                                                 _read_video_frames(test_video, args.frames))
+        print('>>> The first stage of the cascade keeps', round(100 * hits_kept, 1),
+              '% of the hits and the boxes of', round(100 * unchanged, 1),
+              '% of the images and frames', 'OK' if ok else 'FAILED')
+        sys.exit(0 if ok else 1)
+
+    if args.check_track is not None:
+        agreement, ok = check_tracking(_read_video_frames(test_video, args.frames), args.check_track)
+        print('>>> Tracking every', args.check_track, 'frames agrees with the full search on',
+              round(100 * agreement, 1), '% of the frames', 'OK' if ok else 'FAILED')
+        sys.exit(0 if ok else 1)
+
+    if args.check_hog:
+        images = [dip.read_image(path) for path in sorted(glob.glob(test_images))]
+        max_diff, ok = check_hog_backend(images, Prms.HOG_BACKEND)
+        print('>>> The', Prms.HOG_BACKEND, 'hog backend differs from skimage by at most',
+              max_diff, 'OK' if ok else 'FAILED')
+        sys.exit(0 if ok else 1)
+
+    record = run(repeat=args.repeat, n_frames=args.frames)
+    _print_results(record['results'])
+
+    # Store the results so that they can be compared across commits
+    output = args.output
+    if output is None:
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, record['commit'] + '.json')
+    with open(output, 'w') as fid:
+        json.dump(record, fid, indent=2, sort_keys=True)
+    print('>>> Results saved to', output)
+
+    if args.compare:
+        with open(args.compare) as fid:
+            _print_comparison(record['results'], json.load(fid))
@@ -1,8 +1,15 @@
 
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import train_test_split
 from sklearn.svm import LinearSVC
+import numpy as np
 import time
 import pickle
 
+from dip import dip
+from feature_store import scale_in_place
+from parameters import Prms
+
 class My_classifier():
 
     def save(svc):
@@ -46,3 +53,172 @@ class My_classifier():
             My_classifier._check_predictions(svc, X_test, y_test)
 
         return svc
+
+    def classify_cascade(store, X_scaler, columns, vis=False):
+        '''
+        Create and train the first stage of the cascade: a linear svc on a
+        subset of the columns of the feature store, e.g. the color histograms.
+        Its threshold is set on the windows of the search with calibrate_cascade
+        '''
+
+        # The subset of the columns is small enough to be held in memory
+        X = store.columns(columns)
+        X -= X_scaler.mean_[columns]
+        X /= X_scaler.scale_[columns]
+        y = store.labels()
+
+        # Split up the data into randomized training and test sets
+        rand_state = np.random.randint(0, 100)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2,
+                                                            random_state=rand_state)
+
+        # Use a linear SVC
+        svc = LinearSVC()
+        t=time.time()
+        svc.fit(X_train, y_train)
+        t2 = time.time()
+
+        if vis:
+            print(round(t2-t, 2), 'Seconds to train the first stage of the cascade...')
+            print('Test Accuracy of the first stage = ', round(svc.score(X_test, y_test), 4))
+
+        return svc
+
+    def calibrate_cascade(stage, model, images, recall=1.0, vis=False):
+        '''
+        Returns the threshold of the first stage of the cascade, a compiled
+        model on the color histograms, that passes on the given recall of the
+        windows that the full model scores as vehicles in the images. The
+        64x64 training images score differently than the sliding windows, so
+        the threshold is set on the windows of the search itself
+        '''
+
+        columns = dip.hist_columns()
+
+        # First stage scores of the hits of the full search of every field
+        scores = []
+        n_windows = 0
+        for image in images:
+            for field in (Prms.FAR, Prms.MID, Prms.NEAR):
+                features, windows = dip.search_features(image,
+                                                        Prms.Y_START[field],
+                                                        Prms.Y_STOP[field],
+                                                        Prms.SCALE[field],
+                                                        Prms.HOG_CHANNEL,
+                                                        Prms.ORIENT,
+                                                        Prms.PIX_PER_CELL,
+                                                        Prms.CELL_PER_BLOCK,
+                                                        Prms.SPATIAL_SIZE,
+                                                        Prms.N_BINS,
+                                                        xstop=image.shape[1])
+                n_windows += len(features)
+                hits = features[dip.score_windows(features, model, None) > 0]
+                if len(hits) > 0:
+                    scores.append(stage.decision_function(hits[:, columns]))
+        scores = np.concatenate(scores) if scores else np.zeros(0)
+        if len(scores) == 0:
+            raise ValueError('The full model finds no vehicle windows to calibrate the first stage on')
+
+        # Pass on all but the lowest scoring hits
+        threshold = np.percentile(scores, 100 * (1 - recall))
+
+        if vis:
+            print('Hits of the full model in the calibration images = ', len(scores),
+                  'of', n_windows, 'windows')
+            print('Threshold of the first stage = ', round(float(threshold), 4))
+
+        return threshold
+
+    #-------------------------
+    # Out-of-core training
+    #-------------------------
+
+    def _batches(store, X_scaler, idx, batch_size):
+        '''Yields the scaled feature rows and the labels of the indices in mini-batches'''
+
+        labels = store.labels()
+        for start in range(0, len(idx), batch_size):
+            batch_idx = idx[start:start+batch_size]
+            yield scale_in_place(store.rows(batch_idx), X_scaler), labels[batch_idx]
+
+    def _check_predictions_streaming(clf, store, X_scaler, test_idx, batch_size):
+        '''
+        Check the accuracy and sample prediction of the classifier streaming
+        the test set from the feature store
+        '''
+
+        # Check the score of the classifier one mini-batch at a time
+        correct = 0
+        for X_test, y_test in My_classifier._batches(store, X_scaler, test_idx, batch_size):
+            correct += np.sum(clf.predict(X_test) == y_test)
+        print('Test Accuracy of SGD = ', round(correct / max(len(test_idx), 1), 4))
+
+        # Check the prediction time for a single sample
+        n_predict = 10
+        X_test, y_test = next(My_classifier._batches(store, X_scaler, test_idx[:n_predict], n_predict))
+        t=time.time()
+        print('My SGD predicts: ', clf.predict(X_test))
+        print('For these',n_predict, 'labels: ', y_test)
+        t2 = time.time()
+        print(round(t2-t, 5), 'Seconds to predict', n_predict,'labels with SGD')
+
+    def classify_sgd(store, X_scaler=None, clf=None, epochs=5, batch_size=4096, vis=False):
+        '''
+        Create and train a linear SVM with SGD and hinge loss streaming
+        mini-batches from the feature store, so that the dataset does not
+        have to fit in memory. The scaler is fitted streaming the store unless
+        provided, and training continues from clf when provided
+        '''
+
+        # Fit the scaler one chunk at a time
+        if X_scaler is None:
+            X_scaler = store.fit_scaler(batch_size)
+
+        # Split up the indices into randomized training and test sets
+        labels = store.labels()
+        rand_state = np.random.randint(0, 100)
+        train_idx, test_idx = train_test_split(np.arange(len(labels)), test_size=0.2,
+                                               random_state=rand_state)
+
+        # Use a linear SVM trained with stochastic gradient descent
+        if clf is None:
+            clf = SGDClassifier(loss='hinge', alpha=1e-4)
+
+        # Check the training time for the classifier
+        t=time.time()
+        random_state = np.random.RandomState(rand_state)
+        for epoch in range(epochs):
+            # Visit the mini-batches in a new order on each epoch
+            random_state.shuffle(train_idx)
+            for X_batch, y_batch in My_classifier._batches(store, X_scaler, train_idx, batch_size):
+                clf.partial_fit(X_batch, y_batch, classes=np.array([0., 1.]))
+        t2 = time.time()
+
+        if vis:
+            print(round(t2-t, 2), 'Seconds to train SGD...')
+            My_classifier._check_predictions_streaming(clf, store, X_scaler, test_idx, batch_size)
+
+        return clf, X_scaler
+
+    def retrain(store, svc, X_scaler, epochs=1, vis=False):
+        '''
+        Continue the training of a classifier after new parts were added to
+        the feature store, e.g. mined hard negatives, keeping the scaler it was
+        trained with. An SGD classifier continues from its weights with a few
+        epochs over the store, a linear svc has to be refit on the whole store
+        '''
+
+        if hasattr(svc, 'partial_fit'):
+            svc, X_scaler = My_classifier.classify_sgd(store, X_scaler, svc, epochs=epochs, vis=vis)
+            return svc
+
+        # Split up the indices into randomized training and test sets
+        labels = store.labels()
+        rand_state = np.random.randint(0, 100)
+        train_idx, test_idx = train_test_split(np.arange(len(labels)), test_size=0.2,
+                                               random_state=rand_state)
+
+        # Gather and scale the rows of each set and refit the svc
+        X_train = scale_in_place(store.rows(train_idx), X_scaler)
+        X_test = scale_in_place(store.rows(test_idx), X_scaler)
+        return My_classifier.classify(X_train, X_test, labels[train_idx], labels[test_idx], vis=vis)
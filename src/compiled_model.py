@@ -0,0 +1,201 @@
+import json
+import numpy as np
+import os
+import struct
+from collections import OrderedDict
+
+from parameters import Prms
+
+# The model artifacts are a magic, the format version and the length of a
+# JSON header, followed by the float32 arrays, each aligned to 64 bytes so
+# that they can be memory mapped in place
+MAGIC = b'VDMODEL\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# The exported models live next to the sources, wherever the commands are run from
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linear_model.bin')
+FIRST_STAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cascade_stage.bin')
+
+def feature_params(prms=Prms):
+    '''Returns the Prms parameters that the layout of the feature vector depends on'''
+
+    params = OrderedDict([('COLORSPACE', prms.COLORSPACE),
+                          ('SPATIAL_SIZE', prms.SPATIAL_SIZE),
+                          ('N_BINS', prms.N_BINS),
+                          ('ORIENT', prms.ORIENT),
+                          ('PIX_PER_CELL', prms.PIX_PER_CELL),
+                          ('CELL_PER_BLOCK', prms.CELL_PER_BLOCK),
+                          ('HOG_CHANNEL', prms.HOG_CHANNEL),
+                          ('SPATIAL_FEAT', prms.SPATIAL_FEAT),
+                          ('HIST_FEAT', prms.HIST_FEAT),
+                          ('HOG_FEAT', prms.HOG_FEAT)])
+
+    # Compare as stored in the header, e.g. tuples as lists
+    return json.loads(json.dumps(params), object_pairs_hook=OrderedDict)
+
+def _aligned(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+def write_artifact(path, header, arrays, prms=Prms):
+    '''
+    Writes a versioned model artifact with the header fields, the feature
+    parameters of Prms and the named arrays as float32. The file is written
+    next to the path first and moved in place, so that a running detector
+    never reads a partial model
+    '''
+
+    arrays = OrderedDict((name, np.ascontiguousarray(array, dtype='<f4'))
+                         for name, array in arrays.items())
+
+    # Table of the arrays with their offset after the header
+    table = []
+    offset = 0
+    for name, array in arrays.items():
+        table.append([name, offset, list(array.shape)])
+        offset += _aligned(array.nbytes)
+    header = dict(header, params=feature_params(prms), arrays=table)
+    encoded = json.dumps(header).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for (name, offset, shape), array in zip(table, arrays.values()):
+            f.write(b'\x00' * (start + offset - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def read_artifact(path, prms=Prms):
+    '''
+    Reads the header of a model artifact and memory maps its arrays. Fails
+    fast when the artifact has another format version or was trained with
+    other feature parameters than prms, since its weights would not match
+    the features of the windows
+    '''
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a model artifact: {}'.format(path))
+        version, length = struct.unpack('<II', f.read(8))
+        if version != FORMAT_VERSION:
+            raise ValueError('Unsupported model format version {} in {}, expected {}'.format(
+                             version, path, FORMAT_VERSION))
+        header = json.loads(f.read(length).decode('utf-8'))
+
+    # The parameters of the features the model was trained on
+    expected = feature_params(prms)
+    mismatch = ['{}={!r} instead of {!r}'.format(name, header['params'].get(name), value)
+                for name, value in expected.items() if header['params'].get(name) != value]
+    if mismatch:
+        raise ValueError('The model {} was trained with other feature parameters than Prms: {}'.format(
+                         path, ', '.join(mismatch)))
+
+    start = _aligned(len(MAGIC) + 8 + length)
+    arrays = {name: np.memmap(path, dtype='<f4', mode='r', offset=start + offset, shape=tuple(shape))
+              for name, offset, shape in header['arrays']}
+    return header, arrays
+
+class CompiledModel:
+    '''
+    A linear classifier with the feature scaler folded into its weights.
+    Scoring a feature matrix is a single dot product and does not need
+    sklearn at runtime. The statistics of the scaler are kept along with
+    the weights so that the artifact describes the whole trained model
+    '''
+
+    def __init__(self, weights, bias, mean=None, scale=None):
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.float32(bias)
+        self.mean = mean
+        self.scale = scale
+
+    def from_sklearn(svc, X_scaler, columns=slice(None)):
+        '''
+        Folds a fitted StandardScaler into the weights of a fitted linear
+        classifier: w.((x - mean) / scale) + b = (w / scale).x + (b - (w / scale).mean)
+        The classifier may be trained on a subset of the columns of the scaler
+        '''
+
+        # Do the folding in double precision and only store the result as float32
+        weights = np.asarray(svc.coef_, dtype=np.float64).ravel()
+        bias = float(np.asarray(svc.intercept_).ravel()[0])
+        mean = scale = None
+
+        if X_scaler is not None:
+            if X_scaler.scale_ is not None:
+                scale = X_scaler.scale_[columns]
+                weights = weights / scale
+            if X_scaler.mean_ is not None:
+                mean = X_scaler.mean_[columns]
+                bias = bias - np.dot(weights, mean)
+
+        return CompiledModel(weights, bias, mean, scale)
+
+    def decision_function(self, features):
+        '''Returns the raw scores of the feature matrix, one for each row'''
+
+        features = np.asarray(features, dtype=np.float32)
+        return np.dot(features, self.weights) + self.bias
+
+    def predict(self, features):
+        '''Returns 1 for the vehicle and 0 for the non-vehicle rows'''
+
+        return (self.decision_function(features) > 0).astype(np.float64)
+
+    def _arrays(self):
+        '''Returns the weights and the scaler statistics to be saved'''
+
+        arrays = OrderedDict(weights=self.weights)
+        if self.mean is not None:
+            arrays['mean'] = self.mean
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        return arrays
+
+    def save(self, path=MODEL_PATH):
+        '''Save the compiled model to a versioned artifact with the feature parameters of Prms'''
+
+        write_artifact(path, {'kind': 'linear', 'bias': float(self.bias)}, self._arrays())
+
+    def load(path=MODEL_PATH, prms=Prms):
+        '''
+        Load a previously saved compiled model with its weights memory mapped,
+        failing when it does not match the feature parameters of prms
+        '''
+
+        header, arrays = read_artifact(path, prms)
+        return CompiledModel(arrays['weights'], header['bias'],
+                             arrays.get('mean'), arrays.get('scale'))
+
+class CascadeStage:
+    '''
+    The first stage of a two-stage cascade: a compiled linear classifier on
+    the color histogram features of the windows. The windows that score
+    below its threshold are rejected before their hog features are gathered
+    and scored by the full model
+    '''
+
+    def __init__(self, model, threshold):
+        self.model = model
+        self.threshold = np.float32(threshold)
+
+    def accept(self, hist_features):
+        '''Returns the mask of the windows that pass on to the full model'''
+
+        return self.model.decision_function(hist_features) >= self.threshold
+
+    def save(self, path=FIRST_STAGE_PATH):
+        '''Save the first stage to a versioned artifact with the feature parameters of Prms'''
+
+        write_artifact(path, {'kind': 'cascade', 'bias': float(self.model.bias),
+                              'threshold': float(self.threshold)}, self.model._arrays())
+
+    def load(path=FIRST_STAGE_PATH, prms=Prms):
+        '''Load a previously saved first stage, failing when it does not match prms'''
+
+        header, arrays = read_artifact(path, prms)
+        model = CompiledModel(arrays['weights'], header['bias'], arrays.get('mean'), arrays.get('scale'))
+        return CascadeStage(model, header['threshold'])
@@ -1,13 +1,15 @@
 import cv2
+import functools
 import glob
-import matplotlib.pyplot as plt
+import hashlib
+import multiprocessing
 import numpy as np
 import os
 import pickle
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 
 from dip import dip
+from feature_store import FeatureStore, scale_in_place
 from parameters import Prms
 
 def _get_data_from_file():
@@ -48,6 +50,109 @@ def _get_data_from_file():
     # Return a list for the car and a list for the non-car images
     return car_images, non_car_images
 
+#---------------------------
+# Feature extraction workers
+#---------------------------
+
+# Directory of the on-disk feature cache, relative to the ./src directory
+FEATURE_CACHE_DIR = '../feature_cache'
+
+# Directory of the feature store and the name of the part for the ./dataset images
+FEATURE_STORE_DIR = '../feature_store'
+DATASET_PART = 'dataset'
+
+def _feature_params():
+    '''Returns the Prms feature parameters that the extracted features depend on'''
+
+    return (Prms.COLORSPACE, tuple(Prms.SPATIAL_SIZE), Prms.N_BINS, Prms.ORIENT,
+            Prms.PIX_PER_CELL, Prms.CELL_PER_BLOCK, Prms.HOG_CHANNEL,
+            Prms.SPATIAL_FEAT, Prms.HIST_FEAT, Prms.HOG_FEAT)
+
+def _cache_path(image_path, params, cache_dir):
+    '''Returns the cache file of an image keyed by its path, mtime and the feature parameters'''
+
+    key = repr((os.path.abspath(image_path), os.path.getmtime(image_path), params))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+def _image_features(image_path, cache_dir=None):
+    '''
+    Returns the features of an image and its flipped copy as two rows. The
+    rows are read from the cache when the image and the parameters did not
+    change since they were stored
+    '''
+
+    params = _feature_params()
+    if cache_dir is not None:
+        cache_path = _cache_path(image_path, params, cache_dir)
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+    features = dip.extract_features([image_path], color_space=Prms.COLORSPACE,
+                                    spatial_size=Prms.SPATIAL_SIZE,
+                                    hist_bins=Prms.N_BINS,
+                                    orient=Prms.ORIENT,
+                                    pix_per_cell=Prms.PIX_PER_CELL,
+                                    cell_per_block=Prms.CELL_PER_BLOCK,
+                                    hog_channel=Prms.HOG_CHANNEL,
+                                    spatial_feat=Prms.SPATIAL_FEAT,
+                                    hist_feat=Prms.HIST_FEAT,
+                                    hog_feat=Prms.HOG_FEAT)
+    features = np.array(features, dtype=np.float32)
+
+    # Write to a temporary file first so that a worker never reads a partial file
+    if cache_dir is not None:
+        tmp_path = cache_path + '.{}.tmp.npy'.format(os.getpid())
+        np.save(tmp_path, features)
+        os.replace(tmp_path, cache_path)
+
+    return features
+
+def _iter_features(imgs, workers=1, cache=True):
+    '''
+    Extracts the features of a list of images on a pool of worker processes.
+    Yields the features of each image and its flipped copy as two rows,
+    in the order of the images
+    '''
+
+    cache_dir = None
+    if cache:
+        cache_dir = FEATURE_CACHE_DIR
+        os.makedirs(cache_dir, exist_ok=True)
+
+    extract = functools.partial(_image_features, cache_dir=cache_dir)
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for features in pool.imap(extract, imgs, chunksize=64):
+                yield features
+    else:
+        for img in imgs:
+            yield extract(img)
+
+def _store_features(store, cars, notcars, workers=1, cache=True):
+    '''
+    Writes the features of the car and notcar images straight into a
+    preallocated part of the feature store along with their labels
+    '''
+
+    # The length of the feature vector is given by the first image, read
+    # through the cache like the others
+    n_features = next(_iter_features(cars[:1], cache=cache)).shape[1]
+    n_rows = 2 * (len(cars) + len(notcars))
+    X, y = store.create_part(DATASET_PART, n_rows, n_features)
+
+    # Cars are labeled with 1 and notcars with 0
+    row = 0
+    for images, image_label in ((cars, 1), (notcars, 0)):
+        for features in _iter_features(images, workers=workers, cache=cache):
+            X[row:row+len(features)] = features
+            y[row:row+len(features)] = image_label
+            row += len(features)
+
+    # Make sure that the part is written to disk
+    X.flush()
+    y.flush()
+    del X, y
+
 def _data_look(car_list, notcar_list):
     '''Returns some characteristics of the dataset'''
     
@@ -109,32 +214,30 @@ def _hog(car_image):
    # Return the features and the image
     return features, hog_image
 
-def _normalize_features(car_features, notcar_features):
-    '''Normalize the features'''
+def _normalize_features(store):
+    '''Fit the per-column scaler streaming the feature store'''
     
-    # Create an array stack of feature vectors
-    X = np.vstack((car_features, notcar_features)).astype(np.float64)
-    
-    # Fit a per-column scaler
-    X_scaler = StandardScaler().fit(X)
-    
-    # Apply the scaler to X
-    scaled_X = X_scaler.transform(X)
-
-    return X, scaled_X, X_scaler
+    return store.fit_scaler()
     
-def _processed_dataset(X, scaled_X, car_features_n, notcar_features_n):
-    '''Split the dataset into training and test set'''
+def _processed_dataset(store, X_scaler):
+    '''
+    Split the dataset into training and test set by index and scale each
+    set in place, so that the features are only held in memory once
+    '''
     
     # Define the labels vector
-    y = np.hstack((np.ones(car_features_n), np.zeros(notcar_features_n)))
+    y = store.labels()
 
-    # Split up data into randomized training and test sets
+    # Split up the indices into randomized training and test sets
     rand_state = np.random.randint(0, 100)
-    X_train, X_test, y_train, y_test = train_test_split(scaled_X, y, test_size=0.2,
-                                                        random_state=rand_state)
+    train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.2,
+                                           random_state=rand_state)
+
+    # Gather and scale the rows of each set
+    X_train = scale_in_place(store.rows(train_idx), X_scaler)
+    X_test = scale_in_place(store.rows(test_idx), X_scaler)
 
-    return X_train, X_test, y_train, y_test
+    return X_train, X_test, y[train_idx], y[test_idx]
 
 #----------------------
 # Reporting functions
@@ -160,6 +263,8 @@ def _show_vector_length(vector_length):
 #-------------------
 
 def _plot_car_notcar(car_image, notcar_image):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     plt.subplot(121)
     plt.imshow(car_image)
@@ -170,6 +275,8 @@ def _plot_car_notcar(car_image, notcar_image):
     plt.show()
 
 def _plot_hog(car_image, hog_image):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     plt.subplot(121)
     plt.imshow(car_image, cmap='gray')
@@ -180,6 +287,8 @@ def _plot_hog(car_image, hog_image):
     plt.show()
 
 def _plot_normalized_features(X, scaled_X, car_image, car_ind):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(12,4))
     plt.subplot(131)
     plt.imshow(car_image)
@@ -206,42 +315,36 @@ def load_scaler():
         X_scaler = pickle.load(fid)
         return X_scaler
 
-def data_prep(vis=True):
-    '''Explore the dataset and return the cars and not cars images in two different lists'''
-    
-    # 1) Get the car and notcar images from the dataset directories
+def build_feature_store(workers=1, cache=True):
+    '''
+    Writes the features of the car and notcar images of the dataset to the
+    feature store and returns the store along with the image lists
+    '''
+
+    # Get the car and notcar images from the dataset directories
     cars, notcars = _get_data_from_file()
+
+    # Write the car and the not car image features to the feature store
+    # using the global parameters set in Prms class
+    store = FeatureStore(FEATURE_STORE_DIR)
+    _store_features(store, cars, notcars, workers=workers, cache=cache)
+
+    return store, cars, notcars
+
+def data_prep(vis=True, workers=1, cache=True):
+    '''
+    Explore the dataset and return the cars and not cars images in two different lists.
+    The features are extracted on a pool of workers and cached on disk unless disabled
+    '''
     
-    # 2.1) Get the car image features using the global parameters set in Prms class
-    car_features = dip.extract_features(cars, color_space=Prms.COLORSPACE,
-                                        spatial_size=Prms.SPATIAL_SIZE,
-                                        hist_bins=Prms.N_BINS,
-                                        orient=Prms.ORIENT,
-                                        pix_per_cell=Prms.PIX_PER_CELL,
-                                        cell_per_block=Prms.CELL_PER_BLOCK,
-                                        hog_channel=Prms.HOG_CHANNEL,
-                                        spatial_feat=Prms.SPATIAL_FEAT,
-                                        hist_feat=Prms.HIST_FEAT,
-                                        hog_feat=Prms.HOG_FEAT)
-    # 2.2) Get the not car images features
-    notcar_features = dip.extract_features(notcars, color_space=Prms.COLORSPACE,
-                                           spatial_size=Prms.SPATIAL_SIZE,
-                                           hist_bins=Prms.N_BINS,
-                                           orient=Prms.ORIENT,
-                                           pix_per_cell=Prms.PIX_PER_CELL,
-                                           cell_per_block=Prms.CELL_PER_BLOCK,
-                                           hog_channel=Prms.HOG_CHANNEL,
-                                           spatial_feat=Prms.SPATIAL_FEAT,
-                                           hist_feat=Prms.HIST_FEAT,
-                                           hog_feat=Prms.HOG_FEAT)
+    # 1) Get the car and notcar images and write their features to the feature store
+    store, cars, notcars = build_feature_store(workers=workers, cache=cache)
                                         
-    # 3) Combined and normalize the features
-    X, scaled_X, X_scaler = _normalize_features(car_features, notcar_features)
+    # 3) Fit the scaler on the features of all the parts of the store
+    X_scaler = _normalize_features(store)
     
     # 4) Split the dataset into training and test sets
-    X_train, X_test, y_train, y_test = _processed_dataset(X, scaled_X,
-                                                          len(car_features),
-                                                          len(notcar_features))
+    X_train, X_test, y_train, y_test = _processed_dataset(store, X_scaler)
 
     # Show results by default, if not just return the datasets
     if vis:
@@ -259,7 +362,9 @@ def data_prep(vis=True):
         _plot_car_notcar(car_image, notcar_image)
         _show_hog_params()
         _plot_hog(car_image, hog_image)
-        _plot_normalized_features(X, scaled_X, car_image, car_ind)
+        X = store.rows([2 * car_ind]) # Unflipped row of the car image
+        scaled_X = scale_in_place(X.copy(), X_scaler)
+        _plot_normalized_features(X, scaled_X, car_image, 0)
         _show_vector_length(len(X_train[0]))
 
     # Return the training and testing datasets to be used by the classifier
@@ -0,0 +1,245 @@
+
+from compiled_model import FIRST_STAGE_PATH, MODEL_PATH, CascadeStage, CompiledModel
+from dip import dip
+from parameters import Prms
+from telemetry import NULL_TELEMETRY
+from temporal_heat import TemporalHeat
+from tracker import Tracker
+
+from collections import OrderedDict
+import os
+import pickle
+from scipy.ndimage import label
+
+class Detector:
+    '''
+    A vehicle detection session for a single video stream. The classifier,
+    the scaler and the parameters are loaded once when the session is created
+    and the frame book-keeping is kept per session, so that several
+    independent streams can be processed in the same process
+    '''
+
+    def __init__(self, svc=None, X_scaler=None, prms=Prms, model_path=MODEL_PATH,
+                 telemetry=NULL_TELEMETRY, track_every=None, first_stage_path=FIRST_STAGE_PATH):
+        '''
+        Use the compiled model unless a classifier is provided. The scaler is
+        folded into the weights of the classifier so that the windows are
+        scored with a single dot product. The stages of every frame are
+        recorded to the telemetry when it is enabled. With track_every N > 1
+        the frames are searched in full every N frames and only around the
+        tracked vehicles in between. The first stage of the cascade is used
+        when Prms.CASCADE is enabled and it has been trained. Loading a saved
+        model fails when it was trained with other feature parameters, or when
+        neither the compiled model nor the pickled classifier can be loaded
+        '''
+
+        self.prms = prms
+        self.telemetry = telemetry
+        self.track_every = prms.TRACK_EVERY if track_every is None else track_every
+        with self.telemetry.stage('load'):
+            self._load_model(svc, X_scaler, model_path)
+            self.first_stage = None
+            if svc is None and prms.CASCADE and os.path.exists(first_stage_path):
+                self.first_stage = CascadeStage.load(first_stage_path, prms)
+        self.reset()
+
+    def _load_model(self, svc, X_scaler, model_path):
+        '''Load the compiled model or compile the provided or pickled classifier'''
+
+        if isinstance(svc, CompiledModel):
+            self.model = svc
+        elif svc is not None:
+            self.model = CompiledModel.from_sklearn(svc, X_scaler)
+        elif os.path.exists(model_path):
+            self.model = CompiledModel.load(model_path, self.prms)
+        else:
+            # Compile the pickled classifier and scaler of an older training
+            from classifier import My_classifier
+            from data_prep import load_scaler
+            try:
+                svc, X_scaler = My_classifier.load(), load_scaler()
+            except (OSError, ImportError, AttributeError, pickle.UnpicklingError) as e:
+                raise IOError('No model to detect vehicles with: {} does not exist and the pickled '
+                              'classifier and scaler cannot be loaded ({}: {}). Train the classifier '
+                              'with main.py -d'.format(model_path, type(e).__name__, e)) from e
+            self.model = CompiledModel.from_sklearn(svc, X_scaler)
+
+    def reset(self):
+        '''Reset the frame book-keeping to start a new stream'''
+
+        self.frames_total = 0 # Number of frames processed by the session
+        self.search_time = OrderedDict() # Total search time of each stage in seconds
+        self.heat = TemporalHeat(self.prms.HEAT_WINDOW, self.prms.HEAT_DECAY) # Heat of the last frames
+        self.tracker = Tracker(self.prms.TRACK_PAD) # Vehicles of the last frame
+        self.last_hits = [] # Hits of the last full search
+
+    def add_timings(self, timings):
+        '''Add the timings of the multi-scale search of a frame to the totals'''
+
+        self.frames_total += 1
+        stages = [('convert', timings['convert'])]
+        for field, field_time in enumerate(timings['fields']):
+            stages.append(('scale {}'.format(self.prms.SCALE[field]), field_time))
+        stages.append(('score', timings['score']))
+        for stage, stage_time in stages:
+            self.search_time[stage] = self.search_time.get(stage, 0.) + stage_time
+
+    def report(self):
+        '''Print the average search time of each stage per frame'''
+
+        if self.frames_total == 0:
+            return
+        print('>>> Average search time per frame over', self.frames_total, 'frames:')
+        for stage, stage_time in self.search_time.items():
+            print('    {:<10} {:8.2f} ms'.format(stage, 1000 * stage_time / self.frames_total))
+
+    def detect(self, image, rois=None):
+        '''
+        Search a frame for vehicles and return the box list of the detections
+        along with the search timings. The whole frame is searched unless the
+        regions of interest are given. This step does not depend on the
+        previous frames, so frames can be searched in any order or in parallel
+        '''
+
+        p = self.prms
+
+        # Get the box lists from using the hog sub sampling technique for the
+        # far, mid and near field with the windows of all scales scored at once
+        if rois is None:
+            box_lists, scores, timings = dip.find_cars_multiscale(image, self.model, None,
+                                                                  telemetry=self.telemetry,
+                                                                  first_stage=self.first_stage)
+        else:
+            box_lists, scores, timings = dip.find_cars_rois(image, self.model, None, rois,
+                                                            telemetry=self.telemetry,
+                                                            first_stage=self.first_stage)
+        box_list = box_lists[p.FAR] + box_lists[p.MID] + box_lists[p.NEAR]
+
+        # Keep the hits of each scale for the detection records
+        timings['hits'] = [len(box_lists[field]) for field in (p.FAR, p.MID, p.NEAR)]
+
+        return box_list, timings
+
+    def locate(self, shape, box_list):
+        '''
+        Combine the box list of the next frame with the previous frames of
+        the stream and return the boxes of the detected vehicles. Frames
+        must be passed in order
+        '''
+
+        p = self.prms
+
+        with self.telemetry.stage('heatmap'):
+            # Add the heat of the frame to the rolling heat of the last frames
+            # and apply the threshold to help remove false positives
+            self.heat.update(shape, box_list)
+            heatmap = self.heat.heatmap(p.VIDEO_THRESHOLD)
+
+        # Find final boxes from heatmap using label function
+        with self.telemetry.stage('label'):
+            labels = label(heatmap)
+        self.telemetry.count('vehicles', labels[1])
+
+        # Follow the vehicles to the next frame
+        bboxes = dip.labeled_bboxes(labels)
+        self.tracker.update(bboxes)
+
+        return bboxes
+
+    def fuse(self, image, box_list):
+        '''
+        Combine the box list of the next frame with the previous frames of
+        the stream and return the frame with the detected vehicles. Frames
+        must be passed in order
+        '''
+
+        p = self.prms
+        bboxes = self.locate(image.shape, box_list)
+
+        with self.telemetry.stage('draw'):
+            draw_img = dip.draw_boxes(image, bboxes, p.LINE_COLOR, p.LINE_THICKNESS)
+
+        # Return the image with the detected vehicles
+        return draw_img
+
+    def detections(self, shape, box_list, timings):
+        '''
+        Combine the box list of the next frame with the previous frames of
+        the stream like fuse, without drawing, and return the record of the
+        frame: its index, the boxes of the vehicles, the peak of the rolling
+        heat and the hits of each scale. Frames must be passed in order
+        '''
+
+        p = self.prms
+        bboxes = self.locate(shape, box_list)
+
+        record = OrderedDict()
+        record['frame'] = self.frames_total - 1
+        record['boxes'] = [[x1, y1, x2, y2] for (x1, y1), (x2, y2) in bboxes]
+        record['heat_peak'] = self.heat.peak()
+        for field, hits in enumerate(timings['hits']):
+            record['hits_scale_{}'.format(p.SCALE[field])] = hits
+        return record
+
+    def _rois(self, image):
+        '''Returns the regions of interest of the next frame or None for a full search'''
+
+        # Between the full searches only look around the tracked vehicles
+        rois = None
+        if self.track_every > 1 and self.frames_total % self.track_every != 0:
+            rois = self.tracker.rois(image.shape)
+            self.telemetry.count('rois', len(rois))
+        return rois
+
+    def _inside(box, rois):
+        '''Returns whether the center of a box ((x1, y1), (x2, y2)) is in one of the regions'''
+
+        x = (box[0][0] + box[1][0]) / 2
+        y = (box[0][1] + box[1][1]) / 2
+        return any(x1 <= x < x2 and y1 <= y < y2 for x1, y1, x2, y2 in rois)
+
+    def _search(self, image):
+        '''
+        Search the next frame in full, or only in the regions of interest of
+        the tracked vehicles between the full searches. Outside the regions
+        the hits of the last full search are carried forward, so that every
+        frame adds the heat of a whole frame and a vehicle that is not tracked
+        yet still builds up heat between the full searches
+        '''
+
+        rois = self._rois(image)
+        box_list, timings = self.detect(image, rois)
+        if rois is None:
+            self.last_hits = box_list
+        else:
+            box_list = box_list + [box for box in self.last_hits
+                                   if not Detector._inside(box, rois)]
+        return box_list, timings
+
+    def process_frame(self, image):
+        '''
+        Process the next frame of the stream and return the frame
+        with the detected vehicles
+        '''
+
+        self.telemetry.begin_frame(self.frames_total)
+        box_list, timings = self._search(image)
+        self.add_timings(timings)
+        draw_img = self.fuse(image, box_list)
+        self.telemetry.end_frame()
+
+        return draw_img
+
+    def process_detections(self, image):
+        '''
+        Process the next frame of the stream and return its detection record
+        without rendering the frame
+        '''
+
+        self.telemetry.begin_frame(self.frames_total)
+        box_list, timings = self._search(image)
+        self.add_timings(timings)
+        record = self.detections(image.shape, box_list, timings)
+        self.telemetry.end_frame()
+
+        return record
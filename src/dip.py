@@ -1,14 +1,13 @@
 
 import cv2
-import glob
-import matplotlib.pyplot as plt
 import numpy as np
-import pickle
-from scipy.ndimage.measurements import label
-from skimage.feature import hog
-from sklearn.preprocessing import StandardScaler
+import time
+from math import gcd
+from scipy.ndimage import find_objects
 
+import numpy_hog
 from parameters import Prms
+from telemetry import NULL_TELEMETRY
 
 class dip:
     '''Digital Image Processing functions for vehicle detection'''
@@ -69,6 +68,10 @@ class dip:
         
         # Iterate through the bounding boxes
         for bbox in bboxes:
+            # The windows of slide_window() come as (x1, y1, x2, y2) rows
+            if len(bbox) == 4:
+                bbox = ((int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])))
+
             # Draw a rectangle given bbox coordinates
             cv2.rectangle(draw_img, bbox[0], bbox[1], color, thick)
         
@@ -135,33 +138,168 @@ class dip:
         features = cv2.resize(image, size).ravel()
         return features
 
+    def bin_spatial_windows(image, xlefts, ytops, window=64, size=(32, 32)):
+        '''
+        Computes the spatial features of all the windows of an image with one
+        downsample of the whole image. Returns a (n_windows x features) array
+        equal to bin_spatial() applied to each window
+        '''
+
+        n = len(xlefts)
+        factor = window // size[0]
+
+        # The downsampled image gives the same pixels as the downsampled windows
+        # only for an integer factor and windows aligned to it
+        aligned = (window % size[0] == 0 and size[0] == size[1] and
+                   np.all(np.asarray(xlefts) % factor == 0) and
+                   np.all(np.asarray(ytops) % factor == 0))
+        if n == 0 or not aligned:
+            features = [dip.bin_spatial(image[y:y+window, x:x+window], size=size)
+                        for x, y in zip(xlefts, ytops)]
+            return np.array(features).reshape(n, size[0]*size[1]*image.shape[2])
+
+        # Downsample the whole image once, cropped to a multiple of the factor
+        rows = image.shape[0] // factor
+        cols = image.shape[1] // factor
+        small = cv2.resize(image[:rows*factor, :cols*factor], (cols, rows))
+
+        # Gather the pixels of each window from a strided view of the
+        # downsampled image as a grid of windows
+        shape = (rows - size[1] + 1, cols - size[0] + 1, size[1], size[0]) + small.shape[2:]
+        windows = np.lib.stride_tricks.as_strided(small, shape=shape,
+                                                  strides=small.strides[:2] + small.strides,
+                                                  writeable=False)
+        return windows[np.asarray(ytops) // factor, np.asarray(xlefts) // factor].reshape(n, -1)
+
+    def color_hist_windows(image, xlefts, ytops, window=64, nbins=32, bins_range=(0, 256)):
+        '''
+        Computes the color histogram features of all the windows of an image
+        with bincount over precomputed bin indices and an integral histogram
+        of tiles. Returns a (n_windows x features) array equal to color_hist()
+        applied to each window
+        '''
+
+        n = len(xlefts)
+        nchannels = image.shape[2]
+        xlefts = np.asarray(xlefts, dtype=np.int64)
+        ytops = np.asarray(ytops, dtype=np.int64)
+
+        # The bin lookup table needs 8-bit images
+        if n == 0 or image.dtype != np.uint8:
+            features = [dip.color_hist(image[y:y+window, x:x+window], nbins=nbins,
+                                       bins_range=bins_range)
+                        for x, y in zip(xlefts, ytops)]
+            return np.array(features, dtype=np.int64).reshape(n, nchannels*nbins)
+
+        # Tile the image so that every window is made of whole tiles
+        tile = window
+        for position in np.concatenate((xlefts, ytops)):
+            tile = gcd(tile, int(position))
+        ntiles = window // tile
+        nty = (ytops.max() + window) // tile
+        ntx = (xlefts.max() + window) // tile
+
+        # Look up the bin of every pixel value with the same edges as np.histogram(),
+        # where the last bin includes its right edge and values out of range are ignored
+        edges = np.linspace(bins_range[0], bins_range[1], nbins + 1)
+        values = np.arange(256)
+        lut = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, nbins - 1)
+        inside = (values >= bins_range[0]) & (values <= bins_range[1])
+
+        # Count the pixels of each bin for each tile and channel
+        pixels = image[:nty*tile, :ntx*tile]
+        tile_idx = (np.arange(nty*tile) // tile)[:, None] * ntx + (np.arange(ntx*tile) // tile)[None, :]
+        idx = (tile_idx[:, :, None] * nchannels + np.arange(nchannels)) * nbins + lut[pixels]
+        if not np.all(inside):
+            idx = idx[inside[pixels]]
+        counts = np.bincount(idx.ravel(), minlength=nbins*nchannels*nty*ntx)
+        counts = counts.reshape(nty, ntx, nchannels, nbins)
+
+        # Integral histogram over the tiles
+        integral = np.zeros((nty + 1, ntx + 1, nchannels, nbins), dtype=np.int64)
+        integral[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+        # Sum the tiles of each window from the four corners of the integral histogram
+        ty = ytops // tile
+        tx = xlefts // tile
+        hist = integral[ty + ntiles, tx + ntiles] - integral[ty, tx + ntiles] - \
+               integral[ty + ntiles, tx] + integral[ty, tx]
+        return hist.reshape(n, nchannels*nbins)
+
     #------------
     # hog
     #------------
 
     def get_hog_features(img, orient, pix_per_cell, cell_per_block, vis=False, feature_vec=True):
-        '''Returns hog features and visualization'''
+        '''
+        Returns hog features and visualization. The features are computed with
+        the backend selected by Prms.HOG_BACKEND, the visualization with skimage
+        '''
         
         if vis == True:
+            from skimage.feature import hog
             features, hog_image = hog(img,
                                       orientations=orient,
                                       pixels_per_cell=(pix_per_cell, pix_per_cell),
                                       cells_per_block=(cell_per_block, cell_per_block),
                                       block_norm = 'L2-Hys',
                                       transform_sqrt=True,
-                                      visualise=vis,
+                                      visualize=vis,
                                       feature_vector=feature_vec)
             return features, hog_image
         else:
-            features = hog(img,
-                           orientations=orient,
-                           pixels_per_cell=(pix_per_cell, pix_per_cell),
-                           cells_per_block=(cell_per_block, cell_per_block),
-                           block_norm = 'L2-Hys',
-                           transform_sqrt=True,
-                           visualise=vis,
-                           feature_vector=feature_vec)
-            return features
+            return dip.get_hog_channels(img, orient, pix_per_cell, cell_per_block,
+                                        feature_vec=feature_vec)[0]
+
+    def get_hog_channels(img, orient, pix_per_cell, cell_per_block, feature_vec=True,
+                         backend=None):
+        '''
+        Returns a list with the hog features of each channel of an image. The
+        numpy backend computes all the channels in one pass, the skimage
+        backend calls skimage.feature.hog for each channel
+        '''
+
+        backend = Prms.HOG_BACKEND if backend is None else backend
+        channels = img[:,:,None] if img.ndim == 2 else img
+
+        if backend == 'numpy':
+            features = list(numpy_hog.hog_channels(channels, orient, pix_per_cell, cell_per_block))
+        elif backend == 'skimage':
+            from skimage.feature import hog
+            features = [hog(channels[:,:,channel],
+                            orientations=orient,
+                            pixels_per_cell=(pix_per_cell, pix_per_cell),
+                            cells_per_block=(cell_per_block, cell_per_block),
+                            block_norm = 'L2-Hys',
+                            transform_sqrt=True,
+                            feature_vector=False)
+                        for channel in range(channels.shape[2])]
+        else:
+            raise ValueError('Unknown hog backend: {}'.format(backend))
+
+        if feature_vec:
+            features = [channel_features.ravel() for channel_features in features]
+        return features
+
+    def get_hog_batch(images, orient, pix_per_cell, cell_per_block, backend=None):
+        '''
+        Returns the hog feature vectors of a stack of images of the same size
+        as a (n_images x features) matrix, with the channels of each image
+        concatenated as np.hstack(get_hog_channels()). The numpy backend
+        computes the whole stack in one pass
+        '''
+
+        backend = Prms.HOG_BACKEND if backend is None else backend
+        images = images[:,:,:,None] if images.ndim == 3 else images
+
+        if backend == 'numpy':
+            features = numpy_hog.hog_images(images, orient, pix_per_cell, cell_per_block)
+            return features.reshape(len(images), -1)
+        else:
+            features = [np.hstack(dip.get_hog_channels(image, orient, pix_per_cell, cell_per_block,
+                                                       feature_vec=True, backend=backend))
+                        for image in images]
+            return np.array(features).reshape(len(images), -1)
 
     def combined_features(feature_image, spatial_feat, hist_feat, hog_feat, hist_bins, orient,
                           pix_per_cell, cell_per_block, hog_channel, spatial_size):
@@ -183,17 +321,8 @@ class dip:
         # Get the hog features
         if hog_feat == True:
             if hog_channel == 'ALL':
-                hog_features = []
-                hog_feat1 = dip.get_hog_features(feature_image[:,:,0],
-                                                 orient, pix_per_cell, cell_per_block,
-                                                 vis=False, feature_vec=True)
-                hog_feat2 = dip.get_hog_features(feature_image[:,:,1],
-                                                 orient, pix_per_cell, cell_per_block,
-                                                 vis=False, feature_vec=True)
-                hog_feat3 = dip.get_hog_features(feature_image[:,:,2],
-                                                 orient, pix_per_cell, cell_per_block,
-                                                 vis=False, feature_vec=True)
-                hog_features = np.hstack((hog_feat1, hog_feat2, hog_feat3))
+                hog_features = np.hstack(dip.get_hog_channels(feature_image, orient, pix_per_cell,
+                                                              cell_per_block, feature_vec=True))
             else:
                 feature_image = dip.colorspace2RGB(feature_image, Prms.COLORSPACE)
                 feature_image = cv2.cvtColor(feature_image, cv2.COLOR_RGB2GRAY)
@@ -271,14 +400,8 @@ class dip:
         #7) Compute HOG features if flag is set
         if hog_feat == True:
             if hog_channel == 'ALL':
-                hog_features = []
-                for channel in range(feature_image.shape[2]):
-                    hog_features.extend(dip.get_hog_features(feature_image[:,:,channel],
-                                                             orient,
-                                                             pix_per_cell,
-                                                             cell_per_block,
-                                                             vis=False,
-                                                             feature_vec=True))
+                hog_features = np.hstack(dip.get_hog_channels(feature_image, orient, pix_per_cell,
+                                                              cell_per_block, feature_vec=True))
             else:
                 hog_features = dip.get_hog_features(feature_image[:,:,hog_channel],
                                                     orient,
@@ -292,6 +415,49 @@ class dip:
         #9) Return concatenated array of features
         return np.concatenate(img_features)
 
+    def batch_img_features(images, color_space='RGB', spatial_size=(32, 32),
+                           hist_bins=32, orient=9,
+                           pix_per_cell=8, cell_per_block=2, hog_channel=0,
+                           spatial_feat=True, hist_feat=True, hog_feat=True):
+        '''
+        Extracts the features of a (n_windows x 64 x 64 x 3) stack of image
+        windows at once. Returns a (n_windows x features) matrix where each
+        row equals single_img_features() applied to the window
+        '''
+
+        n, window = images.shape[0], images.shape[1]
+
+        # The stacked windows are one tall image with a window every 64 rows
+        tall = np.ascontiguousarray(images).reshape(n*window, images.shape[2], images.shape[3])
+        xlefts = np.zeros(n, dtype=np.int64)
+        ytops = np.arange(n, dtype=np.int64)*window
+
+        #1) Apply color conversion once for all the windows
+        feature_image = dip.convertImageForColorspace(tall, color_space)
+
+        #2) Compute the features of all the windows for each flag that is set
+        img_features = []
+        if spatial_feat == True:
+            img_features.append(dip.bin_spatial_windows(feature_image, xlefts, ytops,
+                                                        window=window, size=spatial_size))
+        if hist_feat == True:
+            img_features.append(dip.color_hist_windows(feature_image, xlefts, ytops,
+                                                       window=window, nbins=hist_bins))
+        if hog_feat == True:
+            feature_images = feature_image.reshape(images.shape)
+            if hog_channel != 'ALL':
+                feature_images = feature_images[:,:,:,hog_channel]
+            img_features.append(dip.get_hog_batch(feature_images, orient, pix_per_cell,
+                                                  cell_per_block))
+
+        #3) Return the feature matrix
+        features = np.empty((n, sum(f.shape[1] for f in img_features)), dtype=np.float32)
+        offset = 0
+        for f in img_features:
+            features[:, offset:offset+f.shape[1]] = f
+            offset += f.shape[1]
+        return features
+
     #---------------------
     # Detecion functions
     #---------------------
@@ -301,128 +467,111 @@ class dip:
         '''
         Takes an image, start and stop positions in both x and y,
         window size (x and y dimensions), and overlap
-        fraction (for both x and y)
+        fraction (for both x and y). Returns the windows as a
+        (n_windows x 4) array of (x1, y1, x2, y2) rows
         '''
         
         # If x and/or y start/stop positions not defined, set to image size
-        if x_start_stop[0] == None:
-            x_start_stop[0] = 0
-        if x_start_stop[1] == None:
-            x_start_stop[1] = img.shape[1]
-        if y_start_stop[0] == None:
-            y_start_stop[0] = 0
-        if y_start_stop[1] == None:
-            y_start_stop[1] = img.shape[0]
+        x_start = 0 if x_start_stop[0] is None else x_start_stop[0]
+        x_stop = img.shape[1] if x_start_stop[1] is None else x_start_stop[1]
+        y_start = 0 if y_start_stop[0] is None else y_start_stop[0]
+        y_stop = img.shape[0] if y_start_stop[1] is None else y_start_stop[1]
         
         # Compute the span of the region to be searched
-        xspan = x_start_stop[1] - x_start_stop[0]
-        yspan = y_start_stop[1] - y_start_stop[0]
+        xspan = x_stop - x_start
+        yspan = y_stop - y_start
 
         # Compute the number of pixels per step in x/y
-        nx_pix_per_step = np.int(xy_window[0]*(1 - xy_overlap[0]))
-        ny_pix_per_step = np.int(xy_window[1]*(1 - xy_overlap[1]))
+        nx_pix_per_step = int(xy_window[0]*(1 - xy_overlap[0]))
+        ny_pix_per_step = int(xy_window[1]*(1 - xy_overlap[1]))
         
         # Compute the number of windows in x/y
-        nx_buffer = np.int(xy_window[0]*(xy_overlap[0]))
-        ny_buffer = np.int(xy_window[1]*(xy_overlap[1]))
-        nx_windows = np.int((xspan-nx_buffer)/nx_pix_per_step)
-        ny_windows = np.int((yspan-ny_buffer)/ny_pix_per_step)
-
-        # Initialize a list to append window positions to
-        window_list = []
-        
-        # Loop through finding x and y window positions
-        # Note: you could vectorize this step, but in practice
-        # you'll be considering windows one by one with your
-        # classifier, so looping makes sense
-        for ys in range(ny_windows):
-            for xs in range(nx_windows):
-                # Calculate window position
-                startx = xs*nx_pix_per_step + x_start_stop[0]
-                endx = startx + xy_window[0]
-                starty = ys*ny_pix_per_step + y_start_stop[0]
-                endy = starty + xy_window[1]
-                
-                # Append window position to list
-                window_list.append(((startx, starty), (endx, endy)))
+        nx_buffer = int(xy_window[0]*(xy_overlap[0]))
+        ny_buffer = int(xy_window[1]*(xy_overlap[1]))
+        nx_windows = max(int((xspan-nx_buffer)/nx_pix_per_step), 0)
+        ny_windows = max(int((yspan-ny_buffer)/ny_pix_per_step), 0)
 
-        # Return the list of windows
-        return window_list
+        # Window positions row by row, as the windows are scanned
+        ys, xs = np.meshgrid(np.arange(ny_windows), np.arange(nx_windows), indexing='ij')
+        startx = xs.ravel()*nx_pix_per_step + x_start
+        starty = ys.ravel()*ny_pix_per_step + y_start
+
+        # Return the array of windows
+        return np.column_stack((startx, starty, startx + xy_window[0],
+                                starty + xy_window[1])).astype(np.int64)
 
     def search_windows(img, windows, clf, scaler, color_space='RGB',
                        spatial_size=(32, 32), hist_bins=32, hist_range=(0, 256),
                        orient=9, pix_per_cell=8, cell_per_block=2, hog_channel=0,
-                       spatial_feat=True, hist_feat=True, hog_feat=True):
+                       spatial_feat=True, hist_feat=True, hog_feat=True, batch_size=256):
         '''
-        Pass an image and the list of windows to be searched (output of slide_windows())
+        Pass an image and the windows to be searched (output of slide_windows()).
+        All the windows are resized into one stack and scored as a batch, the
+        features are extracted batch_size windows at a time to bound the memory.
+        Returns the (x1, y1, x2, y2) rows of the positive detection windows
         '''
-            
-        #1) Create an empty list to receive positive detection windows
-        on_windows = []
-        
-        #2) Iterate over all windows in the list
-        for window in windows:
-            #3) Extract the test window from original image
-            test_img = cv2.resize(img[window[0][1]:window[1][1], window[0][0]:window[1][0]], (64, 64),
-                                  interpolation=cv2.INTER_AREA)
-
-            #4) Extract features for that window using single_img_features()
-            features = dip.single_img_features(test_img, color_space=color_space,
-                                               spatial_size=spatial_size, hist_bins=hist_bins,
-                                               orient=orient, pix_per_cell=pix_per_cell,
-                                               cell_per_block=cell_per_block,
-                                               hog_channel=hog_channel,
-                                               spatial_feat=spatial_feat,
-                                               hist_feat=hist_feat, hog_feat=hog_feat)
-            
-            #5) Scale extracted features to be fed to classifier
-            test_features = scaler.transform(np.array(features).reshape(1, -1))
-            
-            #6) Predict using your classifier
-            prediction = clf.predict(test_features)
+
+        #1) Windows as (x1, y1, x2, y2) rows, also from ((x1, y1), (x2, y2)) pairs
+        windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+        
+        #2) Resize all the test windows from the original image into one stack
+        test_imgs = np.empty((len(windows), 64, 64, img.shape[2]), dtype=img.dtype)
+        for i, (x1, y1, x2, y2) in enumerate(windows):
+            cv2.resize(img[y1:y2, x1:x2], (64, 64), dst=test_imgs[i],
+                       interpolation=cv2.INTER_AREA)
+
+        #3) Extract features for the stack and score them with the classifier
+        scores = np.zeros(len(windows))
+        for start in range(0, len(windows), batch_size):
+            features = dip.batch_img_features(test_imgs[start:start+batch_size],
+                                              color_space=color_space,
+                                              spatial_size=spatial_size, hist_bins=hist_bins,
+                                              orient=orient, pix_per_cell=pix_per_cell,
+                                              cell_per_block=cell_per_block,
+                                              hog_channel=hog_channel,
+                                              spatial_feat=spatial_feat,
+                                              hist_feat=hist_feat, hog_feat=hog_feat)
+            scores[start:start+batch_size] = dip.score_windows(features, clf, scaler)
                 
-            #7) If positive (prediction == 1) then save the window
-            if prediction == 1:
-                on_windows.append(window)
-                    
-        #8) Return windows for positive detections
-        return on_windows
+        #4) Return windows for positive detections
+        return windows[scores > 0]
 
-    def find_cars(img, ystart, ystop, scale, svc, X_scaler, hog_channel,
-                  orient, pix_per_cell, cell_per_block, spatial_size, hist_bins,
-                  xstart=0, xstop=1280):
+    def hog_windows(hog_features, ypos, xpos, nblocks_per_window, out=None):
         '''
-        Extracts features using hog sub-sampling and make predictions
-        Returns the detection boxes coordinates as well as an image showing
-        the cars that are detected
+        Returns the hog features of the windows at the (ypos, xpos) block
+        positions as a (n_windows x features) matrix. The windows are taken
+        from a strided view of the block array without copying each window,
+        and are written to out when given
         '''
-        
-        # Caution: If the image is comming from the video it is RGB. However, if the
-        # image is imported with cv2 it is BGR. This logic is captured in the
-        # convert_color() function above.
-        
-        draw_img = np.copy(img)
-        box_list = []
-        
-        # Crop the image to the prefered search area
-        img_tosearch = img[ystart:ystop,xstart:xstop,:]
-        ctrans_tosearch = dip.convertImageForColorspace(img_tosearch, Prms.COLORSPACE)
-        
-        if scale != 1:
-            imshape = ctrans_tosearch.shape
-            ctrans_tosearch = cv2.resize(ctrans_tosearch, (np.int(imshape[1]/scale), np.int(imshape[0]/scale)))
 
-        # Get the hog channel depending on selection
-        if hog_channel == 0 or hog_channel == 'ALL':
-            ch1 = ctrans_tosearch[:,:,0]
-        if hog_channel == 1 or hog_channel == 'ALL':
-            ch2 = ctrans_tosearch[:,:,1]
-        if hog_channel == 2 or hog_channel == 'ALL':
-            ch3 = ctrans_tosearch[:,:,2]
+        # View the block array as a grid of windows of blocks
+        n_rows, n_cols = hog_features.shape[:2]
+        shape = ((n_rows - nblocks_per_window + 1, n_cols - nblocks_per_window + 1,
+                  nblocks_per_window, nblocks_per_window) + hog_features.shape[2:])
+        strides = hog_features.strides[:2] + hog_features.strides
+        windows = np.lib.stride_tricks.as_strided(hog_features, shape=shape, strides=strides,
+                                                  writeable=False)
+
+        # Gather the windows in one call, each window raveled in block order
+        if out is None:
+            return windows[ypos, xpos].reshape(len(ypos), -1)
+        out[...] = windows[ypos, xpos].reshape(len(ypos), -1)
+        return out
+
+    def window_features(ctrans_tosearch, hog_channel, orient, pix_per_cell,
+                        cell_per_block, spatial_size, hist_bins, telemetry=NULL_TELEMETRY,
+                        first_stage=None):
+        '''
+        Extracts the features of all the windows of an already converted and
+        scaled search area using hog sub-sampling. Returns the feature matrix
+        with one row per window and the (xleft, ytop) position of each window
+        in the scaled search area. With the first stage of a cascade, only the
+        windows it passes on are returned
+        '''
 
         # Define blocks and steps as above
-        nxblocks = (ch1.shape[1] // pix_per_cell) - cell_per_block + 1
-        nyblocks = (ch1.shape[0] // pix_per_cell) - cell_per_block + 1
+        nxblocks = (ctrans_tosearch.shape[1] // pix_per_cell) - cell_per_block + 1
+        nyblocks = (ctrans_tosearch.shape[0] // pix_per_cell) - cell_per_block + 1
         nfeat_per_block = orient*cell_per_block**2
         
         # 64 was the orginal sampling rate, with 8 cells and 8 pix per cell
@@ -432,65 +581,390 @@ class dip:
         nxsteps = (nxblocks - nblocks_per_window) // cells_per_step
         nysteps = (nyblocks - nblocks_per_window) // cells_per_step
         
-        # Compute individual channel HOG features for the entire image and for the selected channel(s)
+        # Window positions in the scaled search area, column by column
+        xb, yb = np.meshgrid(np.arange(max(nxsteps, 0)), np.arange(max(nysteps, 0)), indexing='ij')
+        xlefts = xb.ravel()*cells_per_step*pix_per_cell
+        ytops = yb.ravel()*cells_per_step*pix_per_cell
+        positions = np.column_stack((xlefts, ytops))
+        telemetry.count('windows', len(positions))
+        if len(positions) == 0:
+            return np.zeros((0, 0)), positions
+
+        # The first stage of the cascade rejects the windows on their color
+        # histograms before any hog feature is computed
+        hist_features = None
+        if first_stage is not None:
+            with telemetry.stage('cascade'):
+                hist_features = dip.color_hist_windows(ctrans_tosearch, xlefts, ytops,
+                                                       window=window, nbins=hist_bins)
+                keep = first_stage.accept(hist_features)
+            telemetry.count('rejected', int(len(keep) - np.count_nonzero(keep)))
+            positions, xlefts, ytops = positions[keep], xlefts[keep], ytops[keep]
+            hist_features = hist_features[keep]
+            if len(positions) == 0:
+                return np.zeros((0, 0)), positions
+
+        # Only compute the hog of the area spanned by the windows that are left,
+        # with a margin of a cell so that the gradients on the border of the
+        # windows are the ones of the whole search area. The area starts on
+        # the cell grid, so the blocks of the windows are the same
+        y0 = max(int(ytops.min()) - pix_per_cell, 0)
+        x0 = max(int(xlefts.min()) - pix_per_cell, 0)
+        y1 = min(int(ytops.max()) + window + pix_per_cell, ctrans_tosearch.shape[0])
+        x1 = min(int(xlefts.max()) + window + pix_per_cell, ctrans_tosearch.shape[1])
+        hog_area = ctrans_tosearch[y0:y1, x0:x1]
+
+        # Get the hog channel depending on selection
         if hog_channel == 0 or hog_channel == 'ALL':
-            hog1 = dip.get_hog_features(ch1, orient, pix_per_cell, cell_per_block, feature_vec=False)
+            ch1 = hog_area[:,:,0]
         if hog_channel == 1 or hog_channel == 'ALL':
-            hog2 = dip.get_hog_features(ch2, orient, pix_per_cell, cell_per_block, feature_vec=False)
+            ch2 = hog_area[:,:,1]
         if hog_channel == 2 or hog_channel == 'ALL':
-            hog3 = dip.get_hog_features(ch3, orient, pix_per_cell, cell_per_block, feature_vec=False)
+            ch3 = hog_area[:,:,2]
+
+        # Compute individual channel HOG features for the area and for the selected channel(s)
+        hog1 = hog2 = hog3 = None
+        with telemetry.stage('hog'):
+            if hog_channel == 'ALL':
+                hog1, hog2, hog3 = dip.get_hog_channels(hog_area, orient, pix_per_cell,
+                                                        cell_per_block, feature_vec=False)
+            if hog_channel == 0:
+                hog1 = dip.get_hog_features(ch1, orient, pix_per_cell, cell_per_block, feature_vec=False)
+            if hog_channel == 1:
+                hog2 = dip.get_hog_features(ch2, orient, pix_per_cell, cell_per_block, feature_vec=False)
+            if hog_channel == 2:
+                hog3 = dip.get_hog_features(ch3, orient, pix_per_cell, cell_per_block, feature_vec=False)
         
-        for xb in range(nxsteps):
-            for yb in range(nysteps):
-                ypos = yb*cells_per_step
-                xpos = xb*cells_per_step
-                
-                # Extract HOG for this patch
-                if hog_channel == 0 or hog_channel == 'ALL':
-                    hog_feat1 = hog1[ypos:ypos+nblocks_per_window, xpos:xpos+nblocks_per_window].ravel()
-                    hog_single_channel = hog_feat1
-                if hog_channel == 1 or hog_channel == 'ALL':
-                    hog_feat2 = hog2[ypos:ypos+nblocks_per_window, xpos:xpos+nblocks_per_window].ravel()
-                    hog_single_channel = hog_feat2
-                if hog_channel == 2 or hog_channel == 'ALL':
-                    hog_feat3 = hog3[ypos:ypos+nblocks_per_window, xpos:xpos+nblocks_per_window].ravel()
-                    hog_single_channel = hog_feat3
-
-                # Get the single channel or multi-channel hog features
-                if hog_channel == 'ALL':
-                    hog_features = np.hstack((hog_feat1, hog_feat2, hog_feat3))
-                else:
-                    hog_features = hog_single_channel
-                
-                xleft = xpos*pix_per_cell
-                ytop = ypos*pix_per_cell
-                
-                # Extract the image patch
-                subimg = cv2.resize(ctrans_tosearch[ytop:ytop+window, xleft:xleft+window], (64,64))
-                
-                # Get color features
-                spatial_features = dip.bin_spatial(subimg, size=Prms.SPATIAL_SIZE)
-                hist_features = dip.color_hist(subimg, nbins=Prms.N_BINS)
-                
-                # Scale features and make a prediction
-                test_features = X_scaler.transform(np.hstack((spatial_features, hist_features, hog_features)).reshape(1, -1))
-                test_prediction = svc.predict(test_features)
-                
-                if test_prediction == 1:
-                    xbox_left = np.int(xleft*scale)+xstart
-                    ytop_draw = np.int(ytop*scale)
-                    win_draw = np.int(window*scale)
+        with telemetry.stage('features'):
+            # Preallocate the feature matrix with one row per window so that
+            # all the windows can be scored with a single call
+            hogs = [hog_features for hog_features in (hog1, hog2, hog3)
+                    if hog_features is not None]
+            n_spatial = spatial_size[0]*spatial_size[1]*ctrans_tosearch.shape[2]
+            n_hist = hist_bins*ctrans_tosearch.shape[2]
+            n_hog = nblocks_per_window**2*nfeat_per_block
+            features = np.empty((len(positions), n_spatial + n_hist + n_hog*len(hogs)),
+                                dtype=np.float32)
+
+            # Get color features of all the windows at once
+            features[:, :n_spatial] = dip.bin_spatial_windows(ctrans_tosearch, xlefts, ytops,
+                                                              window=window, size=spatial_size)
+            if hist_features is None:
+                hist_features = dip.color_hist_windows(ctrans_tosearch, xlefts, ytops,
+                                                       window=window, nbins=hist_bins)
+            features[:, n_spatial:n_spatial+n_hist] = hist_features
+
+            # Extract HOG for all the patches from a strided view of the blocks
+            offset = n_spatial + n_hist
+            for hog_features in hogs:
+                dip.hog_windows(hog_features, (ytops - y0) // pix_per_cell, (xlefts - x0) // pix_per_cell,
+                                nblocks_per_window, out=features[:, offset:offset+n_hog])
+                offset += n_hog
+
+        # Return the feature matrix and the window positions
+        return features, positions
+
+    def hist_columns(spatial_size=Prms.SPATIAL_SIZE, hist_bins=Prms.N_BINS):
+        '''Returns the columns of the color histograms in the feature vector of a window'''
+
+        start = spatial_size[0]*spatial_size[1]*3
+        return slice(start, start + hist_bins*3)
+
+    def score_windows(features, svc, X_scaler, telemetry=NULL_TELEMETRY):
+        '''
+        Scales the feature matrix and returns the raw decision function
+        scores of the classifier with a single call for all the windows.
+        A window is a vehicle detection when its score is positive. Pass
+        X_scaler=None for a CompiledModel that has the scaler folded in
+        '''
 
-                    # Draw the box on the image
-                    cv2.rectangle(draw_img,(xbox_left, ytop_draw+ystart),(xbox_left+win_draw,ytop_draw+win_draw+ystart),Prms.LINE_COLOR,Prms.LINE_THICKNESS)
+        # The scaler does not accept an empty feature matrix
+        if len(features) == 0:
+            return np.zeros(0)
 
-                    # Extract the bbox coordinates
-                    box = (xbox_left, ytop_draw+ystart),(xbox_left+win_draw,ytop_draw+win_draw+ystart)
-                    box_list.append(box)
+        with telemetry.stage('predict'):
+            # A compiled model has the scaler folded in and comes without one
+            if X_scaler is not None:
+                features = X_scaler.transform(features)
+
+            return svc.decision_function(features)
+
+    def scaled_features(ctrans_tosearch, scale, ystart, xstart, hog_channel, orient,
+                        pix_per_cell, cell_per_block, spatial_size, hist_bins,
+                        telemetry=NULL_TELEMETRY, first_stage=None):
+        '''
+        Scales an already cropped and converted search area and extracts the
+        features of all its windows, or of the windows passed on by the first
+        stage of a cascade. Returns the feature matrix and the box of each
+        window in the original image coordinates
+        '''
+
+        if scale != 1:
+            with telemetry.stage('resize'):
+                imshape = ctrans_tosearch.shape
+                ctrans_tosearch = cv2.resize(ctrans_tosearch, (int(imshape[1]/scale), int(imshape[0]/scale)))
+
+        # Get the features of all the windows
+        features, positions = dip.window_features(ctrans_tosearch, hog_channel, orient,
+                                                  pix_per_cell, cell_per_block,
+                                                  spatial_size, hist_bins, telemetry,
+                                                  first_stage)
+
+        # Get the window boxes in the original image coordinates
+        win_draw = int(64*scale)
+        box_list = []
+        for xleft, ytop in positions:
+            xbox_left = int(xleft*scale)+xstart
+            ytop_draw = int(ytop*scale)
+            box = (xbox_left, ytop_draw+ystart),(xbox_left+win_draw,ytop_draw+win_draw+ystart)
+            box_list.append(box)
+
+        # Return the features along with the window boxes
+        return features, box_list
+
+    def search_features(img, ystart, ystop, scale, hog_channel, orient, pix_per_cell,
+                        cell_per_block, spatial_size, hist_bins, xstart=0, xstop=1280,
+                        telemetry=NULL_TELEMETRY):
+        '''
+        Crops, converts and scales the search area and extracts the features of
+        all its windows. Returns the feature matrix and the box of each window
+        in the original image coordinates
+        '''
+
+        # Caution: If the image is comming from the video it is RGB. However, if the
+        # image is imported with cv2 it is BGR. This logic is captured in the
+        # convert_color() function above.
+        
+        # Crop the image to the prefered search area
+        with telemetry.stage('convert'):
+            img_tosearch = img[ystart:ystop,xstart:xstop,:]
+            ctrans_tosearch = dip.convertImageForColorspace(img_tosearch, Prms.COLORSPACE)
+
+        return dip.scaled_features(ctrans_tosearch, scale, ystart, xstart, hog_channel,
+                                   orient, pix_per_cell, cell_per_block, spatial_size,
+                                   hist_bins, telemetry)
+
+    def find_windows(img, ystart, ystop, scale, svc, X_scaler, hog_channel,
+                     orient, pix_per_cell, cell_per_block, spatial_size, hist_bins,
+                     xstart=0, xstop=1280, telemetry=NULL_TELEMETRY):
+        '''
+        Extracts features using hog sub-sampling and scores all the windows
+        with a single scale and predict call. Returns the boxes of all the
+        searched windows and their decision function scores
+        '''
+
+        features, box_list = dip.search_features(img, ystart, ystop, scale, hog_channel,
+                                                 orient, pix_per_cell, cell_per_block,
+                                                 spatial_size, hist_bins, xstart, xstop,
+                                                 telemetry)
+        scores = dip.score_windows(features, svc, X_scaler, telemetry)
+
+        # Return all the boxes along with their scores
+        return box_list, scores
+
+    def find_cars(img, ystart, ystop, scale, svc, X_scaler, hog_channel,
+                  orient, pix_per_cell, cell_per_block, spatial_size, hist_bins,
+                  xstart=0, xstop=1280, threshold=0.0, telemetry=NULL_TELEMETRY):
+        '''
+        Extracts features using hog sub-sampling and make predictions
+        Returns the detection boxes coordinates as well as an image showing
+        the cars that are detected
+        '''
+        
+        draw_img = np.copy(img)
+
+        # Score all the windows of the search area at once
+        windows, scores = dip.find_windows(img, ystart, ystop, scale, svc, X_scaler,
+                                           hog_channel, orient, pix_per_cell,
+                                           cell_per_block, spatial_size, hist_bins,
+                                           xstart, xstop, telemetry)
+
+        # A positive score above the threshold is a vehicle detection
+        box_list = [windows[i] for i in np.flatnonzero(scores > threshold)]
+        telemetry.count('hits', len(box_list))
+
+        # Draw the boxes on the image
+        for box in box_list:
+            cv2.rectangle(draw_img, box[0], box[1], Prms.LINE_COLOR, Prms.LINE_THICKNESS)
 
         # Return the image with the vehicle detection overlay
         return draw_img, box_list
 
+    def field_detections(fields, all_windows, scores, threshold=0.0, telemetry=NULL_TELEMETRY):
+        '''
+        Splits the scores of the windows of all the fields, scored in the
+        order of the fields, back to each field. Returns the box list of the
+        windows scored above the threshold and the scores for each field
+        '''
+
+        box_lists = []
+        field_scores = []
+        start = 0
+        for field, windows in zip(fields, all_windows):
+            stop = start + len(windows)
+            box_lists.append([windows[i] for i in np.flatnonzero(scores[start:stop] > threshold)])
+            field_scores.append(scores[start:stop])
+            telemetry.count('hits_scale_{}'.format(Prms.SCALE[field]), len(box_lists[-1]))
+            start = stop
+        telemetry.count('hits', sum(len(box_list) for box_list in box_lists))
+
+        return box_lists, field_scores
+
+    def find_cars_multiscale(img, svc, X_scaler, fields=(Prms.FAR, Prms.MID, Prms.NEAR),
+                             use_xstart=True, threshold=0.0, xstop=1280,
+                             telemetry=NULL_TELEMETRY, first_stage=None):
+        '''
+        Runs the hog sub-sampling search on the FAR, MID and NEAR fields. The
+        union of the search areas is converted to the colorspace once, each
+        field is scaled once and the windows of all the scales are scored with
+        a single scale and predict call. With the first stage of a cascade
+        only the windows it passes on are scored. Returns the box list and the
+        window scores for each field as well as the time spent in each stage
+        '''
+
+        timings = {}
+        t = time.time()
+
+        # Convert the union of the search areas to the colorspace once
+        xstarts = [Prms.X_START[field] if use_xstart else 0 for field in fields]
+        y0 = min(Prms.Y_START[field] for field in fields)
+        y1 = max(Prms.Y_STOP[field] for field in fields)
+        x0 = min(xstarts)
+        with telemetry.stage('convert'):
+            ctrans_union = dip.convertImageForColorspace(img[y0:y1,x0:xstop,:], Prms.COLORSPACE)
+        timings['convert'] = time.time() - t
+
+        # Collect the features of all the scales
+        all_features = []
+        all_windows = []
+        timings['fields'] = []
+        for field, xstart in zip(fields, xstarts):
+            t = time.time()
+            ystart = Prms.Y_START[field]
+            ctrans_tosearch = ctrans_union[ystart-y0:Prms.Y_STOP[field]-y0, xstart-x0:,:]
+            features, windows = dip.scaled_features(ctrans_tosearch,
+                                                    Prms.SCALE[field],
+                                                    ystart, xstart,
+                                                    Prms.HOG_CHANNEL,
+                                                    Prms.ORIENT,
+                                                    Prms.PIX_PER_CELL,
+                                                    Prms.CELL_PER_BLOCK,
+                                                    Prms.SPATIAL_SIZE,
+                                                    Prms.N_BINS,
+                                                    telemetry,
+                                                    first_stage)
+            if len(features) > 0:
+                all_features.append(features)
+            all_windows.append(windows)
+            timings['fields'].append(time.time() - t)
+
+        # Score the windows of all the scales at once
+        t = time.time()
+        if len(all_features) > 0:
+            scores = dip.score_windows(np.vstack(all_features), svc, X_scaler, telemetry)
+        else:
+            scores = np.zeros(0)
+        timings['score'] = time.time() - t
+
+        # Split the scores back to the fields and keep the detections
+        box_lists, field_scores = dip.field_detections(fields, all_windows, scores,
+                                                       threshold, telemetry)
+
+        # Return the detections, the raw scores and the timings for each field
+        return box_lists, field_scores, timings
+
+    def roi_search_area(roi, field, shape, use_xstart=True):
+        '''
+        Returns the search area (ystart, ystop, xstart, xstop) of a field within
+        a region of interest (x1, y1, x2, y2), or None when they do not
+        overlap. The region is grown by a window and a step in every direction
+        so that the area holds all the windows of the full search of the field
+        that overlap the region, and its origin is snapped to their grid
+        '''
+
+        scale = Prms.SCALE[field]
+        y0, y1 = Prms.Y_START[field], Prms.Y_STOP[field]
+        x0 = Prms.X_START[field] if use_xstart else 0
+        x1 = shape[1]
+
+        # Grow the region by a window and a step of 2 cells as in window_features
+        step = 2*Prms.PIX_PER_CELL*scale
+        margin = int(np.ceil(64*scale + step))
+        ystart, ystop = max(roi[1] - margin, y0), min(roi[3] + margin, y1)
+        xstart, xstop = max(roi[0] - margin, x0), min(roi[2] + margin, x1)
+
+        # Skip the fields that the region does not overlap
+        if min(roi[3], y1) <= max(roi[1], y0) or min(roi[2], x1) <= max(roi[0], x0):
+            return None
+
+        # Snap the origin to the grid so that the windows are the ones of the full search
+        ystart = y0 + int((ystart - y0) // step * step)
+        xstart = x0 + int((xstart - x0) // step * step)
+
+        return ystart, ystop, xstart, xstop
+
+    def find_cars_rois(img, svc, X_scaler, rois, fields=(Prms.FAR, Prms.MID, Prms.NEAR),
+                       use_xstart=True, threshold=0.0, telemetry=NULL_TELEMETRY,
+                       first_stage=None):
+        '''
+        Runs the hog sub-sampling search of the FAR, MID and NEAR fields only
+        within the regions of interest (x1, y1, x2, y2) of the frame, e.g.
+        around the tracked vehicles. Returns the box list and the window
+        scores for each field and the timings like find_cars_multiscale
+        '''
+
+        timings = {'convert': 0., 'fields': [0.] * len(fields)}
+
+        # Collect the features of all the regions and scales
+        all_features = []
+        all_windows = [[] for field in fields]
+        for roi in rois:
+            for i, field in enumerate(fields):
+                area = dip.roi_search_area(roi, field, img.shape, use_xstart)
+                if area is None:
+                    continue
+                ystart, ystop, xstart, xstop = area
+
+                t = time.time()
+                with telemetry.stage('convert'):
+                    ctrans_tosearch = dip.convertImageForColorspace(img[ystart:ystop,xstart:xstop,:],
+                                                                    Prms.COLORSPACE)
+                timings['convert'] += time.time() - t
+
+                t = time.time()
+                features, windows = dip.scaled_features(ctrans_tosearch,
+                                                        Prms.SCALE[field],
+                                                        ystart, xstart,
+                                                        Prms.HOG_CHANNEL,
+                                                        Prms.ORIENT,
+                                                        Prms.PIX_PER_CELL,
+                                                        Prms.CELL_PER_BLOCK,
+                                                        Prms.SPATIAL_SIZE,
+                                                        Prms.N_BINS,
+                                                        telemetry,
+                                                        first_stage)
+                if len(features) > 0:
+                    all_features.append((i, features))
+                    all_windows[i] += windows
+                timings['fields'][i] += time.time() - t
+
+        # Score the windows of all the regions at once, ordered by field
+        t = time.time()
+        all_features.sort(key=lambda item: item[0])
+        if len(all_features) > 0:
+            scores = dip.score_windows(np.vstack([features for i, features in all_features]),
+                                       svc, X_scaler, telemetry)
+        else:
+            scores = np.zeros(0)
+        timings['score'] = time.time() - t
+
+        # Split the scores back to the fields and keep the detections
+        box_lists, field_scores = dip.field_detections(fields, all_windows, scores,
+                                                       threshold, telemetry)
+
+        # Return the detections, the raw scores and the timings for each field
+        return box_lists, field_scores, timings
+
     #---------
     # Heatmap
     #---------
@@ -512,19 +986,88 @@ class dip:
         # Return thresholded map
         return heatmap
 
+    def heat_band(shape, y_range=None):
+        '''Returns the first and the last + 1 row of the heat, by default the searched rows'''
+
+        if y_range is None:
+            y_range = (min(Prms.Y_START), max(Prms.Y_STOP))
+        y_top = max(y_range[0], 0)
+        return y_top, max(min(y_range[1], shape[0]), y_top)
+
+    def box_heat(shape, bbox_list, y_range=None):
+        '''
+        Returns the heat of a box list over the rows of the heat band as an
+        int32 array. Each box adds +1/-1 deltas at its corners instead of
+        incrementing all of its pixels, and the heat is recovered with a
+        cumulative sum along both axes
+        '''
+
+        width = shape[1]
+        y_top, y_bottom = dip.heat_band(shape, y_range)
+        if len(bbox_list) == 0 or y_bottom == y_top:
+            return np.zeros((y_bottom - y_top, width), dtype=np.int32)
+
+        # Clip the boxes ((x1, y1), (x2, y2)) to the band like the slices of add_heat
+        boxes = np.asarray(bbox_list, dtype=np.int64).reshape(-1, 4)
+        x1 = np.clip(boxes[:,0], 0, width)
+        x2 = np.clip(boxes[:,2], 0, width)
+        y1 = np.clip(boxes[:,1], y_top, y_bottom) - y_top
+        y2 = np.clip(boxes[:,3], y_top, y_bottom) - y_top
+
+        # Corner deltas in a band with one extra row and column for the far corners
+        rows, cols = y_bottom - y_top + 1, width + 1
+        plus = np.concatenate((y1 * cols + x1, y2 * cols + x2))
+        minus = np.concatenate((y1 * cols + x2, y2 * cols + x1))
+        deltas = (np.bincount(plus, minlength=rows * cols) -
+                  np.bincount(minus, minlength=rows * cols)).astype(np.int32)
+
+        # Integrate the deltas into the heat of each pixel
+        return deltas.reshape(rows, cols).cumsum(axis=0).cumsum(axis=1)[:-1,:-1]
+
+    def threshold_heat(shape, heat, threshold=0, y_range=None):
+        '''
+        Returns the heatmap of the image shape from the heat of the band, as
+        a uint8 image clipped to 255 like the visualized heatmap. The pixels
+        below the threshold are zeroed out in the same pass
+        '''
+
+        y_top, y_bottom = dip.heat_band(shape, y_range)
+        heatmap = np.zeros(shape[:2], dtype=np.uint8)
+        heat = np.where(heat > threshold, heat, 0)
+        np.minimum(heat, 255, out=heatmap[y_top:y_bottom], casting='unsafe')
+        return heatmap
+
+    def heatmap(shape, bbox_list, threshold=0, y_range=None):
+        '''
+        Returns the thresholded heatmap of a box list accumulated over the
+        rows of y_range, by default the searched rows
+        '''
+
+        heat = dip.box_heat(shape, bbox_list, y_range)
+        return dip.threshold_heat(shape, heat, threshold, y_range)
+
+    def labeled_bboxes(labels):
+        '''
+        Returns the bounding box ((x1, y1), (x2, y2)) of each labeled car, in
+        label order, with a single pass over the labeled image
+        '''
+
+        bboxes = []
+        for car_slice in find_objects(labels[0], labels[1]):
+            # A label that does not appear in the image has no slice
+            if car_slice is None:
+                continue
+
+            # Define a bounding box based on min/max x and y
+            y_slice, x_slice = car_slice[0], car_slice[1]
+            bboxes.append(((x_slice.start, y_slice.start), (x_slice.stop - 1, y_slice.stop - 1)))
+
+        # Return the bounding boxes
+        return bboxes
+
     def draw_labeled_bboxes(img, labels):
         # Iterate through all detected cars
-        for car_number in range(1, labels[1]+1):
-            # Find pixels with each car_number label value
-            nonzero = (labels[0] == car_number).nonzero()
-            
-            # Identify x and y values of those pixels
-            nonzeroy = np.array(nonzero[0])
-            nonzerox = np.array(nonzero[1])
-            
-            # Define a bounding box based on min/max x and y
-            bbox = ((np.min(nonzerox), np.min(nonzeroy)), (np.max(nonzerox), np.max(nonzeroy)))
-            
+        for bbox in dip.labeled_bboxes(labels):
             # Draw the box on the image
             cv2.rectangle(img, bbox[0], bbox[1], Prms.LINE_COLOR, Prms.LINE_THICKNESS)
         
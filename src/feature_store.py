@@ -0,0 +1,125 @@
+
+import glob
+import numpy as np
+import os
+
+class FeatureStore:
+    '''
+    On-disk store of the training features. Each part of the store is a
+    float32 .npy memmap with one row per sample and a label array next to
+    it, so that the features never have to be held in memory as a whole and
+    new datasets can be added as new parts without rewriting the old ones
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _part_paths(self, name):
+        '''Returns the feature and the label file of a part'''
+        return (os.path.join(self.path, name + '_X.npy'),
+                os.path.join(self.path, name + '_y.npy'))
+
+    def part_names(self):
+        '''Returns the names of the parts of the store in order'''
+
+        paths = sorted(glob.glob(os.path.join(self.path, '*_X.npy')))
+        return [os.path.basename(path)[:-len('_X.npy')] for path in paths]
+
+    def create_part(self, name, n_rows, n_features):
+        '''
+        Preallocates a part of the store, replacing any part with the same name,
+        and returns the writable feature and label memmaps to be filled in
+        '''
+
+        X_path, y_path = self._part_paths(name)
+        X = np.lib.format.open_memmap(X_path, mode='w+', dtype=np.float32,
+                                      shape=(n_rows, n_features))
+        y = np.lib.format.open_memmap(y_path, mode='w+', dtype=np.int8, shape=(n_rows,))
+        return X, y
+
+    def remove_part(self, name):
+        '''Removes a part from the store'''
+
+        for path in self._part_paths(name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def parts(self, mode='r'):
+        '''Returns the feature and label memmaps of all the parts'''
+
+        parts = []
+        for name in self.part_names():
+            X_path, y_path = self._part_paths(name)
+            parts.append((np.load(X_path, mmap_mode=mode), np.load(y_path, mmap_mode=mode)))
+        return parts
+
+    def __len__(self):
+        return sum(len(y) for X, y in self.parts())
+
+    def n_features(self):
+        '''Returns the length of the feature vectors of the store'''
+
+        n_features = set(X.shape[1] for X, y in self.parts())
+        if len(n_features) > 1:
+            raise ValueError('The parts of the feature store have different feature lengths')
+        return n_features.pop() if n_features else 0
+
+    def labels(self):
+        '''Returns the labels of all the samples of the store'''
+
+        labels = [np.asarray(y, dtype=np.float64) for X, y in self.parts()]
+        return np.concatenate(labels) if labels else np.zeros(0)
+
+    def rows(self, idx):
+        '''
+        Gathers the feature rows with the given global indices in a float32
+        array, reading each part in index order to keep the disk access sequential
+        '''
+
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.empty((len(idx), self.n_features()), dtype=np.float32)
+
+        offset = 0
+        for X, y in self.parts():
+            positions = np.flatnonzero((idx >= offset) & (idx < offset + len(X)))
+            local = idx[positions] - offset
+            order = np.argsort(local)
+            out[positions[order]] = X[local[order]]
+            offset += len(X)
+
+        return out
+
+    def columns(self, columns, chunk_size=4096):
+        '''Gathers a subset of the columns of all the rows in a float32 array, in chunks'''
+
+        parts = []
+        for X, y in self.parts():
+            for start in range(0, len(X), chunk_size):
+                parts.append(np.array(X[start:start+chunk_size, columns], dtype=np.float32))
+        return np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+
+    def chunks(self, chunk_size=4096):
+        '''Yields the feature and label rows of the store in chunks'''
+
+        for X, y in self.parts():
+            for start in range(0, len(X), chunk_size):
+                yield (np.asarray(X[start:start+chunk_size]),
+                       np.asarray(y[start:start+chunk_size], dtype=np.float64))
+
+    def fit_scaler(self, chunk_size=4096):
+        '''Fits a per-column scaler on the whole store streaming it in chunks'''
+
+        from sklearn.preprocessing import StandardScaler
+        X_scaler = StandardScaler()
+        for X, y in self.chunks(chunk_size):
+            X_scaler.partial_fit(X)
+        return X_scaler
+
+def scale_in_place(X, X_scaler, chunk_size=4096):
+    '''Applies a fitted scaler to a float32 feature matrix in place, in chunks'''
+
+    for start in range(0, len(X), chunk_size):
+        X[start:start+chunk_size] -= X_scaler.mean_
+        X[start:start+chunk_size] /= X_scaler.scale_
+    return X
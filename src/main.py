@@ -1,19 +1,13 @@
+import time
+startup = [('start', time.perf_counter())] # End of each startup phase for --timing
 
-from classifier import My_classifier
-from data_prep import *
-from dip import dip
-from pipelines import Pipelines
-from parameters import Prms
-from plotting import Plotting
-
-import cv2
-import glob
-import numpy as np
-import matplotlib.pyplot as plt
+# Only the light modules are loaded up front, each command loads the rest
+# of what it needs so that short runs do not pay for plotting or training
+import argparse
+import sys
 from enum import Enum
-from moviepy.editor import VideoFileClip
-from os import sys
-from scipy.ndimage.measurements import label
+
+from parameters import Prms
 
 #----------
 # Globals
@@ -27,59 +21,151 @@ class Commands(Enum):
     NONE = 0
     DATA = 1
     IMAGE = 2
+    MINE = 3
+    BATCH = 4
+    CASCADE = 5
 
 #------------
 # Functions
 #------------
 
-def help():
-    print()
-    print("> -d: Dataset set up and classifier training")
-    print("> -i: Test the classifier on test images")
-    print("> Run the vehicle detection on video")
-    print()
-
 def parseCommands():
     '''Parse the command line arguments'''
     
-    command = Commands.NONE
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '-d':
-            command = Commands.DATA
-        elif sys.argv[1] == '-i':
-            command = Commands.IMAGE
-        else:
-            help()
-            exit(0)
+    parser = argparse.ArgumentParser(description='Vehicle detection')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-d', dest='command', action='store_const', const=Commands.DATA,
+                       help='Dataset set up and classifier training')
+    group.add_argument('-i', dest='command', action='store_const', const=Commands.IMAGE,
+                       help='Test the classifier on test images')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of worker processes for the feature extraction '
+                             'and the video detection')
+    parser.add_argument('--telemetry', nargs='?', const='', default=None, metavar='PATH',
+                        help='Record the per-stage telemetry of the video frames and '
+                             'optionally write it to a .csv or .jsonl file')
+    parser.add_argument('--track', type=int, default=None, metavar='N',
+                        help='Search the video frames in full every N frames and only '
+                             'around the tracked vehicles in between (serial pipeline only)')
+    parser.add_argument('--input', metavar='SOURCE',
+                        help='Video file, camera index, named pipe or directory of images '
+                             'to run the detection on instead of the project video')
+    parser.add_argument('--output', metavar='PATH',
+                        help='Video file, or directory for numbered images, with the detections '
+                             '(default: {}), or directory of the annotated images of a batch'.format(video_out))
+    parser.add_argument('--detections', metavar='PATH',
+                        help='Only write the detections of each frame to a .jsonl or .csv '
+                             'file, without rendering nor encoding the video')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep waiting for new images in the input directory')
+    parser.add_argument('--batch', nargs='+', metavar='SOURCE',
+                        help='Detect the vehicles of the images of directories, .txt lists of '
+                             'image paths or image files without display, to annotated images '
+                             'in --output and/or detections in --detections')
+    parser.add_argument('--mine', metavar='GROUND_TRUTH',
+                        help='Mine the false positives of the video outside the vehicle boxes '
+                             'of a .jsonl or .csv file as non-vehicles and retrain the classifier')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Train the first stage of the cascade on the feature store and set its '
+                             'threshold on the vehicle windows of the test video, or of --input')
+    parser.add_argument('--timing', action='store_true',
+                        help='Report the time spent importing the modules and loading the model')
+    parser.add_argument('--sgd', action='store_true',
+                        help='Train out-of-core with SGD streaming the feature store')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Do not use the on-disk feature cache for training')
+    parser.set_defaults(command=Commands.NONE)
+    args = parser.parse_args()
+
+    # Mining runs on the video but ends with a training
+    if args.mine is not None:
+        args.command = Commands.MINE
+
+    # So does the training of the first stage of the cascade
+    if args.cascade:
+        args.command = Commands.CASCADE
+
+    # A batch of images needs somewhere to write its results
+    if args.batch is not None:
+        args.command = Commands.BATCH
+        if args.output is None and args.detections is None:
+            parser.error('--batch needs --output and/or --detections')
 
-    return command
+    return args.command, args
+
+def export_models(svc, X_scaler):
+    '''Save the classifier and the scaler and export the compiled model'''
+
+    from classifier import My_classifier
+    from compiled_model import CompiledModel
+    from data_prep import save_scaler
+
+    save_scaler(X_scaler)
+    My_classifier.save(svc)
+
+    # Export the compiled model with the scaler folded into the weights
+    CompiledModel.from_sklearn(svc, X_scaler).save()
+
+def startup_phase(phase):
+    '''Mark the end of a startup phase'''
+    startup.append((phase, time.perf_counter()))
+
+def print_startup():
+    '''Print the time spent in each startup phase since the start of the CLI'''
+
+    print('>>> Startup in {:.1f} ms with {} modules loaded:'.format(
+          1000 * (startup[-1][1] - startup[0][1]), len(sys.modules)))
+    for (previous, t0), (phase, t1) in zip(startup, startup[1:]):
+        print('    {:<10} {:8.1f} ms'.format(phase, 1000 * (t1 - t0)))
 
 #--------
 # Main
 #--------
 
 if __name__ == '__main__':
-    command = parseCommands()
+    command, args = parseCommands()
+    startup_phase('cli')
     if command == Commands.DATA:
         print(">>> Setting up dataset and training the classifier")
+        from classifier import My_classifier
+        from data_prep import build_feature_store, data_prep
+        startup_phase('imports')
+        if args.timing: print_startup()
 
         # 1) Explore the colorspace in debug mode only
-        if Prms.DEBUG: Plotting.exploreColorSpace()
+        if Prms.DEBUG:
+            from plotting import Plotting
+            Plotting.exploreColorSpace()
         
-        # 2) Get the training and test datasets
-        X_train, X_test, y_train, y_test, X_scaler = data_prep(vis=True)
-        save_scaler(X_scaler)
+        if args.sgd:
+            # 2) Write the dataset features to the feature store
+            store, cars, notcars = build_feature_store(workers=args.workers, cache=args.cache)
+
+            # 3) Train the classifier streaming mini-batches from the store
+            svc, X_scaler = My_classifier.classify_sgd(store, vis=True)
+        else:
+            # 2) Get the training and test datasets
+            X_train, X_test, y_train, y_test, X_scaler = data_prep(vis=True, workers=args.workers,
+                                                                 cache=args.cache)
         
-        # 3) Train the classifier
-        svc = My_classifier.classify(X_train, X_test, y_train, y_test, vis=True)
-        My_classifier.save(svc)
+            # 3) Train the classifier
+            svc = My_classifier.classify(X_train, X_test, y_train, y_test, vis=True)
+
+        # 4) Save the classifier and export the compiled model
+        export_models(svc, X_scaler)
     
     elif command == Commands.IMAGE:
         print(">>> Testing the classifier on images")
+        from detector import Detector
+        from pipelines import Pipelines
+        startup_phase('imports')
         
-        # 1) Load the classifier and the scaler
-        svc = My_classifier.load()
-        X_scaler = load_scaler()
+        # 1) Load the compiled model with the scaler folded in, or compile the
+        # pickled classifier and scaler when it has not been exported yet
+        svc = Detector().model
+        X_scaler = None
+        startup_phase('model')
+        if args.timing: print_startup()
         
         # 2) Test the classifier on test images with the sliding window on debug mode
         if Prms.DEBUG:
@@ -94,15 +180,130 @@ if __name__ == '__main__':
         print(">>> Displaing the heatmap of the sub sampling processed images")
         Pipelines.heat(svc, X_scaler)
 
+    elif command == Commands.MINE:
+        print(">>> Mining hard negatives and retraining the classifier")
+        from classifier import My_classifier
+        from data_prep import FEATURE_STORE_DIR, load_scaler
+        from detector import Detector
+        from feature_store import FeatureStore
+        from mining import HardNegativeMiner
+        startup_phase('imports')
+
+        # 1) Mine the video, or the requested source, with the current model
+        video, subclip = (video_in_test if Prms.DEBUG else video_in), Prms.SUBCLIP
+        if args.input is not None:
+            video, subclip = args.input, None
+        store = FeatureStore(FEATURE_STORE_DIR)
+        miner = HardNegativeMiner(Detector(), store)
+        startup_phase('model')
+        if args.timing: print_startup()
+        n = miner.mine(video, args.mine, subclip=subclip)
+        print('>>> Mined', n, 'hard negative windows')
+
+        # 2) Continue the training on the grown store with the same scaler
+        if n > 0:
+            X_scaler = load_scaler()
+            svc = My_classifier.retrain(store, My_classifier.load(), X_scaler,
+                                        epochs=Prms.MINE_EPOCHS, vis=True)
+            export_models(svc, X_scaler)
+
+    elif command == Commands.CASCADE:
+        print(">>> Training the first stage of the cascade")
+        from classifier import My_classifier
+        from compiled_model import CascadeStage, CompiledModel
+        from data_prep import FEATURE_STORE_DIR, load_scaler
+        from detector import Detector
+        from dip import dip
+        from feature_store import FeatureStore
+        from streams import FrameReader
+        startup_phase('imports')
+        if args.timing: print_startup()
+
+        # 1) Train the first stage on the color histograms of the feature store
+        X_scaler = load_scaler()
+        columns = dip.hist_columns()
+        first = My_classifier.classify_cascade(FeatureStore(FEATURE_STORE_DIR), X_scaler,
+                                               columns, vis=True)
+        stage = CompiledModel.from_sklearn(first, X_scaler, columns)
+
+        # 2) Set its threshold on the windows that the full model finds in the video
+        video = video_in_test if args.input is None else args.input
+        threshold = My_classifier.calibrate_cascade(stage, Detector().model, FrameReader(video),
+                                                    Prms.CASCADE_RECALL, vis=True)
+        CascadeStage(stage, threshold).save()
+        print('>>> Enable Prms.CASCADE once benchmark.py --check-cascade finds the same vehicles')
+
+    elif command == Commands.BATCH:
+        print(">>> Detecting the vehicles of a batch of images")
+        from pipelines import Pipelines
+        from streams import image_paths
+        startup_phase('imports')
+        if args.timing: print_startup()
+
+        # The model is loaded by each worker, the images are read ahead on threads
+        paths = image_paths(args.batch)
+        Pipelines.image_batch(paths, max(args.workers, 1), output_dir=args.output,
+                              detections=args.detections)
+
     else:
         print(">>> Running the classifier on video")
+        from telemetry import NULL_TELEMETRY, Telemetry
         
-        # 1) Get the video clip for debuging or release
+        # 1) Get the video clip for debuging or release, or the requested source
         video = video_in_test if Prms.DEBUG else video_in
+        subclip = Prms.SUBCLIP
+        if args.input is not None:
+            video, subclip = args.input, None
+        output = video_out if args.output is None else args.output
         
-        # 2) Run the video through the pipeline
-        clip = VideoFileClip(video)
-        white_clip = clip.fl_image(Pipelines.video_pipeline).subclip(
-                                                                     Prms.SUBCLIP[0],
-                                                                     Prms.SUBCLIP[1])
-        white_clip.write_videofile(video_out, audio=False)
+        # 2) Record the telemetry of the frames when requested
+        telemetry = NULL_TELEMETRY
+        if args.telemetry is not None:
+            # A watched source never ends, so only the sink keeps the frames
+            telemetry = Telemetry(sink=args.telemetry, keep=not args.watch)
+
+        # 3) Run the video through the pipeline on a pool of workers
+        if args.workers > 1:
+            # The model is loaded by each worker
+            from pipelines import Pipelines
+            startup_phase('imports')
+            if args.timing: print_startup()
+            Pipelines.video_parallel(video, output, args.workers, subclip=subclip,
+                                     telemetry=telemetry, watch=args.watch,
+                                     detections=args.detections)
+        else:
+            from detector import Detector
+            from streams import DetectionWriter, FrameReader, FrameWriter
+            startup_phase('imports')
+
+            # Load the classifier and the scaler once for the whole video
+            detector = Detector(telemetry=telemetry, track_every=args.track)
+            startup_phase('model')
+            if args.timing: print_startup()
+
+            # Stream the frames through the detector, decoding each frame into
+            # the buffer of the previous one, and write the rendered frames or
+            # only the detections
+            t = time.time()
+            reader = FrameReader(video, subclip=subclip, watch=args.watch, reuse=True)
+            if args.detections is not None:
+                writer, process = DetectionWriter(args.detections), detector.process_detections
+            else:
+                writer, process = FrameWriter(output, reader.fps), detector.process_frame
+            try:
+                for frame in reader:
+                    writer.write(process(frame))
+            finally:
+                reader.close()
+                writer.close()
+            elapsed = time.time() - t
+            print('>>> Processed', detector.frames_total, 'frames in', round(elapsed, 2),
+                  'seconds:', round(detector.frames_total / max(elapsed, 1e-9), 2),
+                  'frames per second')
+
+            # Show where the frame budget of the search goes
+            detector.report()
+
+        # 4) Show the per-stage summary of the telemetry
+        telemetry.print_summary()
+        telemetry.close()
@@ -0,0 +1,138 @@
+
+from dip import dip
+from parameters import Prms
+from streams import FrameReader
+
+import csv
+import cv2
+import json
+import numpy as np
+import os
+
+class HardNegativeMiner:
+    '''
+    Mines the hard negatives of a video: the windows that the detector scores
+    as vehicles away from the known vehicle boxes of their frame. The windows
+    are resized to 64 x 64 like the training images and written along with
+    their flipped copy as a new part of non-vehicles in the feature store, so
+    that the classifier can be trained further on them. The search is not
+    masked by X_START, so that the opposing lane is mined as well
+    '''
+
+    def __init__(self, detector, store, max_overlap=Prms.MINE_OVERLAP, every=Prms.MINE_EVERY,
+                 limit=Prms.MINE_LIMIT, use_xstart=False):
+        self.detector = detector
+        self.store = store
+        self.max_overlap = max_overlap
+        self.every = every
+        self.limit = limit
+        self.use_xstart = use_xstart
+
+    def load_ground_truth(path):
+        '''
+        Returns the vehicle boxes [x1, y1, x2, y2] of each frame of a .jsonl or
+        .csv file keyed by the frame index, in the format of the detection
+        records so that a corrected --detections run can be used. The frames
+        without a record are not mined
+        '''
+
+        with open(path, newline='') as f:
+            if path.endswith('.csv'):
+                records = [dict(row, frame=int(row['frame']), boxes=json.loads(row['boxes']))
+                           for row in csv.DictReader(f)]
+            else:
+                records = [json.loads(line) for line in f if line.strip()]
+
+        return {record['frame']: np.array(record['boxes'], dtype=np.int64).reshape(-1, 4)
+                for record in records}
+
+    def _overlap(windows, boxes):
+        '''Returns the largest fraction of each window (x1, y1, x2, y2) that is inside one of the boxes'''
+
+        if len(boxes) == 0:
+            return np.zeros(len(windows))
+
+        # Intersection of every window with every box
+        w = np.minimum(windows[:, None, 2], boxes[None, :, 2]) - np.maximum(windows[:, None, 0], boxes[None, :, 0])
+        h = np.minimum(windows[:, None, 3], boxes[None, :, 3]) - np.maximum(windows[:, None, 1], boxes[None, :, 1])
+        inside = np.clip(w, 0, None) * np.clip(h, 0, None)
+        area = (windows[:, 2] - windows[:, 0]) * (windows[:, 3] - windows[:, 1])
+        return inside.max(axis=1) / area
+
+    def false_positives(self, image, boxes):
+        '''
+        Returns the (x1, y1, x2, y2) rows of the windows of a frame that are
+        scored as vehicles and lie outside the vehicle boxes of the frame
+        '''
+
+        box_lists, scores, timings = dip.find_cars_multiscale(image, self.detector.model, None,
+                                                              use_xstart=self.use_xstart,
+                                                              xstop=image.shape[1],
+                                                              first_stage=self.detector.first_stage)
+        windows = np.array([[x1, y1, x2, y2] for box_list in box_lists
+                            for (x1, y1), (x2, y2) in box_list], dtype=np.int64).reshape(-1, 4)
+
+        return windows[HardNegativeMiner._overlap(windows, boxes) <= self.max_overlap]
+
+    def mine(self, source, ground_truth, subclip=None, part=None):
+        '''
+        Runs the detector over every few frames of the video that have ground
+        truth boxes and writes the false positive windows to a part of the
+        feature store, named after the video unless given. Returns the number
+        of mined windows
+        '''
+
+        truth = HardNegativeMiner.load_ground_truth(ground_truth)
+        if part is None:
+            part = 'hard_negatives_' + os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+
+        # Resize the windows into a preallocated stack of training images
+        crops = np.empty((self.limit, 64, 64, 3), dtype=np.uint8)
+        n = 0
+        for frame, image in enumerate(FrameReader(source, subclip=subclip)):
+            if n == self.limit:
+                break
+            if frame % self.every != 0 or frame not in truth:
+                continue
+            for x1, y1, x2, y2 in self.false_positives(image, truth[frame])[:self.limit - n]:
+                cv2.resize(image[y1:y2, x1:x2], (64, 64), dst=crops[n], interpolation=cv2.INTER_AREA)
+                n += 1
+
+        if n > 0:
+            self.write(crops[:n], part)
+        return n
+
+    def write(self, crops, part, batch_size=256):
+        '''
+        Writes the features of the 64 x 64 windows and of their flipped copy
+        to a part of the feature store as non-vehicles, in the row order of
+        the training images
+        '''
+
+        def features(images):
+            return dip.batch_img_features(images, color_space=Prms.COLORSPACE,
+                                          spatial_size=Prms.SPATIAL_SIZE,
+                                          hist_bins=Prms.N_BINS,
+                                          orient=Prms.ORIENT,
+                                          pix_per_cell=Prms.PIX_PER_CELL,
+                                          cell_per_block=Prms.CELL_PER_BLOCK,
+                                          hog_channel=Prms.HOG_CHANNEL,
+                                          spatial_feat=Prms.SPATIAL_FEAT,
+                                          hist_feat=Prms.HIST_FEAT,
+                                          hog_feat=Prms.HOG_FEAT)
+
+        # The length of the feature vector is given by the first window
+        n_features = features(crops[:1]).shape[1]
+        X, y = self.store.create_part(part, 2 * len(crops), n_features)
+        y[:] = 0
+
+        # Each window is followed by its flipped copy
+        for start in range(0, len(crops), batch_size):
+            batch = crops[start:start+batch_size]
+            X[2*start:2*(start+len(batch)):2] = features(batch)
+            X[2*start+1:2*(start+len(batch)):2] = features(batch[:, :, ::-1])
+
+        # Make sure that the part is written to disk
+        X.flush()
+        y.flush()
+        del X, y
@@ -0,0 +1,125 @@
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def _gradients(channels):
+    '''
+    Returns the row and column gradients of a (channels x rows x cols) stack
+    with the central difference and zero gradients on the border, as skimage
+    '''
+
+    g_row = np.zeros_like(channels)
+    g_row[:, 1:-1, :] = channels[:, 2:, :] - channels[:, :-2, :]
+    g_col = np.zeros_like(channels)
+    g_col[:, :, 1:-1] = channels[:, :, 2:] - channels[:, :, :-2]
+    return g_row, g_col
+
+def _cell_histograms(g_row, g_col, orient, pix_per_cell):
+    '''
+    Returns the (channels x cell rows x cell cols x orient) histograms of the
+    gradient magnitudes binned by their unsigned orientation. A pixel votes
+    for the single bin its orientation falls in, as skimage
+    '''
+
+    n_channels, rows, cols = g_row.shape
+    n_cells_row, n_cells_col = rows // pix_per_cell, cols // pix_per_cell
+
+    # Only the pixels of the whole cells vote
+    g_row = g_row[:, :n_cells_row*pix_per_cell, :n_cells_col*pix_per_cell]
+    g_col = g_col[:, :n_cells_row*pix_per_cell, :n_cells_col*pix_per_cell]
+    magnitude = np.hypot(g_row, g_col)
+    orientation = np.arctan2(g_row, g_col)
+    np.rad2deg(orientation, out=orientation)
+    np.mod(orientation, 180, out=orientation)
+
+    # The bin edges are single precision as in skimage, and an orientation
+    # past the last edge does not vote
+    edges = np.float32(180. / orient) * np.arange(orient + 1, dtype=np.float32)
+    bins = np.searchsorted(edges.astype(np.float64), orientation, side='right') - 1
+    magnitude[bins >= orient] = 0
+    np.minimum(bins, orient - 1, out=bins)
+
+    # Index of the cell and the bin of each pixel, built in place of the bins
+    cell_rows = np.arange(g_row.shape[1]) // pix_per_cell
+    cell_cols = np.arange(g_row.shape[2]) // pix_per_cell
+    bins += ((np.arange(n_channels)[:, None, None] * n_cells_row + cell_rows[None, :, None])
+             * n_cells_col + cell_cols[None, None, :]) * orient
+
+    histograms = np.bincount(bins.ravel(), weights=magnitude.ravel(),
+                             minlength=n_channels * n_cells_row * n_cells_col * orient)
+    histograms /= pix_per_cell * pix_per_cell
+    return histograms.reshape(n_channels, n_cells_row, n_cells_col, orient)
+
+def _blocks(histograms, cell_per_block):
+    '''
+    Returns a strided view of the overlapping blocks of the cell histograms as
+    (channels x block rows x block cols x cell_per_block x cell_per_block x orient)
+    '''
+
+    n_channels, n_cells_row, n_cells_col, orient = histograms.shape
+    s_ch, s_row, s_col, s_orient = histograms.strides
+    shape = (n_channels, n_cells_row - cell_per_block + 1, n_cells_col - cell_per_block + 1,
+             cell_per_block, cell_per_block, orient)
+    strides = (s_ch, s_row, s_col, s_row, s_col, s_orient)
+    return as_strided(histograms, shape=shape, strides=strides, writeable=False)
+
+def _normalized_blocks(channels, orient, pix_per_cell, cell_per_block, eps):
+    '''
+    Returns the L2-Hys normalized blocks of a (channels x rows x cols) stack
+    of square rooted channels, each channel on its own
+    '''
+
+    n_cells_row = channels.shape[1] // pix_per_cell
+    n_cells_col = channels.shape[2] // pix_per_cell
+    if n_cells_row < cell_per_block or n_cells_col < cell_per_block:
+        raise ValueError('The image is too small for the hog cells and blocks')
+
+    # Histograms of the gradient orientations of each cell
+    g_row, g_col = _gradients(channels)
+    histograms = _cell_histograms(g_row.astype(np.float64, copy=False),
+                                  g_col.astype(np.float64, copy=False), orient, pix_per_cell)
+
+    # L2-Hys normalization of each block
+    blocks = _blocks(histograms, cell_per_block)
+    axes = (3, 4, 5)
+    norm = np.sqrt(np.sum(blocks**2, axis=axes, keepdims=True) + eps**2)
+    normalized = np.minimum(blocks / norm, 0.2)
+    normalized /= np.sqrt(np.sum(normalized**2, axis=axes, keepdims=True) + eps**2)
+    return normalized
+
+def hog_channels(image, orient, pix_per_cell, cell_per_block, eps=1e-5):
+    '''
+    Computes the hog features of all the channels of an image at once, with
+    the square root transform and the L2-Hys block normalization. Returns a
+    (channels x block rows x block cols x cell_per_block x cell_per_block x
+    orient) array where each channel equals skimage.feature.hog with
+    feature_vector=False within floating point tolerance
+    '''
+
+    # Stack the channels on the first axis
+    if image.ndim == 2:
+        image = image[:, :, None]
+    dtype = np.float32 if image.dtype == np.float32 else np.float64
+    channels = np.sqrt(np.moveaxis(image, 2, 0).astype(dtype))
+
+    normalized = _normalized_blocks(channels, orient, pix_per_cell, cell_per_block, eps)
+    return normalized.astype(dtype, copy=False)
+
+def hog_images(images, orient, pix_per_cell, cell_per_block, eps=1e-5):
+    '''
+    Computes the hog features of all the channels of a stack of images of the
+    same size at once. Returns an (images x channels x block rows x block cols
+    x cell_per_block x cell_per_block x orient) array where each image equals
+    hog_channels() applied to it, since the gradients stop at the border of
+    every image as they do at the border of every channel
+    '''
+
+    # Stack the channels of all the images on the first axis
+    if images.ndim == 3:
+        images = images[:, :, :, None]
+    n_images, rows, cols, n_channels = images.shape
+    dtype = np.float32 if images.dtype == np.float32 else np.float64
+    channels = np.sqrt(np.moveaxis(images, 3, 1).astype(dtype)).reshape(-1, rows, cols)
+
+    normalized = _normalized_blocks(channels, orient, pix_per_cell, cell_per_block, eps)
+    return normalized.astype(dtype, copy=False).reshape((n_images, n_channels) + normalized.shape[1:])
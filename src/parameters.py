@@ -12,7 +12,12 @@ class Prms:
     # Hog subsampling and heatmap
     IMAGE_THRESHOLD = 2
     VIDEO_THRESHOLD = 28
-    FRAMES_MAX      = 10
+    HEAT_WINDOW     = 10 # Frames of the rolling heat of the video
+    HEAT_DECAY      = 1.0 # Weight of the heat of a frame against the next one
+
+    # Tracking between the full searches of the video frames
+    TRACK_EVERY     = 1 # Full search every N frames, 1 searches every frame in full
+    TRACK_PAD       = 0.5 # Padding of the regions of interest as a fraction of the box
     
     # Indices for the Y and X lists
     FAR             = 0
@@ -31,6 +36,19 @@ class Prms:
     XY_WINDOW       = (128, 128)
     XY_OVERLAP      = (0.85, 0.85)
 
+    # Hog implementation, 'numpy' for all the channels in one pass or 'skimage'
+    HOG_BACKEND     = 'numpy'
+
+    # Cascade with a first stage on the color histograms, when trained. Only
+    # enable it when benchmark.py --check-cascade finds the same vehicles
+    CASCADE         = False
+
+    # Hard negative mining of the video frames
+    MINE_OVERLAP    = 0.1 # Largest fraction of a mined window inside a vehicle box
+    MINE_EVERY      = 5 # Mine every N frames, consecutive frames give the same windows
+    MINE_LIMIT      = 5000 # Most windows mined from a video
+    MINE_EPOCHS     = 1 # Epochs of the incremental training on the grown feature store
+
     # Look and feel
     LINE_THICKNESS  = 4
     LINE_COLOR      = (0, 255, 0)
@@ -53,3 +71,6 @@ class Prms:
     SPATIAL_FEAT    = True
     HIST_FEAT       = True
     HOG_FEAT        = True
+
+    # Vehicle windows of the calibration frames passed by the first stage of the cascade
+    CASCADE_RECALL  = 1.0
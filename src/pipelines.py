@@ -1,34 +1,38 @@
 
-from classifier import My_classifier
-from data_prep import *
+from detector import Detector
 from dip import dip
 from parameters import Prms
+from telemetry import NULL_TELEMETRY, Telemetry
 
 import cv2
 import glob
+import multiprocessing
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.ndimage.measurements import label
+import os
+import time
+from collections import OrderedDict, deque
+from scipy.ndimage import label
+from streams import DetectionWriter, FrameReader, FrameWriter, ImageReader
 
 class Pipelines:
 
-    # Parameters for frame processing
-    frame_n = 0 # Keeps track of the frames
-    frame_group_box_list = [] # Box list for a group of frames
-    last_full_box_list = [] # Last full box list for a group of frames
-    
-    # Note: The max numner of frames is set in the Parameters class
+    # Default detection session for the video pipeline. The frame book-keeping
+    # lives in the session, use a Detector per stream for multiple streams
+    detector = None
 
     def hot_windows(svc, X_scaler, vis=False):
         '''Check the classifier by applying the vehicle detection to the test images'''
 
+        import matplotlib.pyplot as plt
+
         for img in glob.glob('../test_images/test*.jpg'):
             image = dip.read_image(img)
             draw_image = np.copy(image)
 
+            # Slide the windows over the far, mid and near field at once
             windows = dip.slide_window(image,
                                        x_start_stop=[None, None],
-                                       y_start_stop=[Prms.Y_START, Prms.Y_STOP],
+                                       y_start_stop=[min(Prms.Y_START), max(Prms.Y_STOP)],
                                        xy_window=Prms.XY_WINDOW,
                                        xy_overlap=Prms.XY_OVERLAP)
                         
@@ -56,6 +60,8 @@ class Pipelines:
     def hog_sub_sampling(svc, X_scaler):
         '''Apply hog sub-sampling to an image to locate cars with one search'''
 
+        import matplotlib.pyplot as plt
+
         for img in glob.glob('../test_images/test*.jpg'):
             image = dip.read_image(img)
             
@@ -76,67 +82,38 @@ class Pipelines:
             plt.imshow(out_img)
             plt.show()
 
+    def locate_image(image, svc, X_scaler, first_stage=None):
+        '''
+        Locate the vehicles of a single image with the hog sub sampling search
+        of the far, mid and near field without masking the opposing lane and
+        a thresholded heatmap of the hits. Returns the vehicle boxes, the
+        heatmap and the number of hits
+        '''
+
+        # Get the box list from using the hog sub sampling technique on the
+        # far, mid and near field without masking the opposing lane
+        box_lists, scores, timings = dip.find_cars_multiscale(image, svc, X_scaler,
+                                                              use_xstart=False,
+                                                              first_stage=first_stage)
+        box_list = box_lists[Prms.FAR] + box_lists[Prms.MID] + box_lists[Prms.NEAR]
+
+        # Add heat to each box in box list and apply threshold to help
+        # remove false positives
+        heatmap = dip.heatmap(image.shape, box_list, Prms.IMAGE_THRESHOLD)
+
+        # Find final boxes from heatmap using label function
+        labels = label(heatmap)
+        return dip.labeled_bboxes(labels), heatmap, len(box_list)
+
     def heat(svc, X_scaler):
         '''Apply a heat map on the test images to validate performance'''
 
+        import matplotlib.pyplot as plt
+
         for img in glob.glob('../test_images/test*.jpg'):
             image = dip.read_image(img)
-            
-            # Create an empty heat map to draw on
-            heat = np.zeros_like(image[:,:,0]).astype(np.float)
-
-            # Get the box list from using the hog sub sampling technique
-            out_img, box_list_far = dip.find_cars(image,
-                                                  Prms.Y_START[Prms.FAR],
-                                                  Prms.Y_STOP[Prms.FAR],
-                                                  Prms.SCALE[Prms.FAR],
-                                                  svc, X_scaler,
-                                                  Prms.HOG_CHANNEL,
-                                                  Prms.ORIENT,
-                                                  Prms.PIX_PER_CELL,
-                                                  Prms.CELL_PER_BLOCK,
-                                                  Prms.SPATIAL_SIZE,
-                                                  Prms.N_BINS)
-            
-            out_img, box_list_mid = dip.find_cars(image,
-                                                  Prms.Y_START[Prms.MID],
-                                                  Prms.Y_STOP[Prms.MID],
-                                                  Prms.SCALE[Prms.MID],
-                                                  svc, X_scaler,
-                                                  Prms.HOG_CHANNEL,
-                                                  Prms.ORIENT,
-                                                  Prms.PIX_PER_CELL,
-                                                  Prms.CELL_PER_BLOCK,
-                                                  Prms.SPATIAL_SIZE,
-                                                  Prms.N_BINS)
-            
-            out_img, box_list_near = dip.find_cars(image,
-                                                   Prms.Y_START[Prms.NEAR],
-                                                   Prms.Y_STOP[Prms.NEAR],
-                                                   Prms.SCALE[Prms.NEAR],
-                                                   svc, X_scaler,
-                                                   Prms.HOG_CHANNEL,
-                                                   Prms.ORIENT,
-                                                   Prms.PIX_PER_CELL,
-                                                   Prms.CELL_PER_BLOCK,
-                                                   Prms.SPATIAL_SIZE,
-                                                   Prms.N_BINS)
-
-            # out_images are discarded at this time
-            box_list = box_list_far + box_list_mid + box_list_near
-
-            # Add heat to each box in box list
-            heat = dip.add_heat(heat, box_list)
-
-            # Apply threshold to help remove false positives
-            heat = dip.apply_threshold(heat, Prms.IMAGE_THRESHOLD)
-
-            # Visualize the heatmap when displaying
-            heatmap = np.clip(heat, 0, 255)
-
-            # Find final boxes from heatmap using label function
-            labels = label(heatmap)
-            draw_img = dip.draw_labeled_bboxes(np.copy(image), labels)
+            bboxes, heatmap, hits = Pipelines.locate_image(image, svc, X_scaler)
+            draw_img = dip.draw_boxes(image, bboxes, Prms.LINE_COLOR, Prms.LINE_THICKNESS)
 
             # Display the results
             fig = plt.figure()
@@ -154,89 +131,197 @@ class Pipelines:
         The main pipeline to process the video from the front camera of the car and
         returns the video with the detected vehicles
         '''
-        
-        # Frames book-keeping
-        if Pipelines.frame_n >= Prms.FRAMES_MAX:
-            # Reset the number of frames counter
-            Pipelines.frame_n = 0
-            
-            # We have processed the max number of frames so we can store
-            # the sum of their box lists to. The assignment is passed by value
-            # rather than reference
-            Pipelines.last_full_box_list = Pipelines.frame_group_box_list[:]
-            
-            # Reset the frame group box list to process a new group of frames
-            Pipelines.frame_group_box_list[:] = []
-        
-        # Increase the frame for the next itteration
-        Pipelines.frame_n = Pipelines.frame_n + 1
-        
-        # Load the classifier and the scaler
-        svc = My_classifier.load()
-        X_scaler = load_scaler()
-
-        # Create an empty heat map to draw on
-        heat = np.zeros_like(image[:,:,0]).astype(np.float)
-        
-        # Get the box list from using the hog sub sampling technique
-        # For the far field
-        out_img, box_list_far = dip.find_cars(image,
-                                              Prms.Y_START[Prms.FAR],
-                                              Prms.Y_STOP[Prms.FAR],
-                                              Prms.SCALE[Prms.FAR],
-                                              svc, X_scaler,
-                                              Prms.HOG_CHANNEL,
-                                              Prms.ORIENT,
-                                              Prms.PIX_PER_CELL,
-                                              Prms.CELL_PER_BLOCK,
-                                              Prms.SPATIAL_SIZE,
-                                              Prms.N_BINS,
-                                              Prms.X_START[Prms.FAR])
 
-        # Mid field
-        out_img, box_list_mid = dip.find_cars(image,
-                                              Prms.Y_START[Prms.MID],
-                                              Prms.Y_STOP[Prms.MID],
-                                              Prms.SCALE[Prms.MID],
-                                              svc, X_scaler,
-                                              Prms.HOG_CHANNEL,
-                                              Prms.ORIENT,
-                                              Prms.PIX_PER_CELL,
-                                              Prms.CELL_PER_BLOCK,
-                                              Prms.SPATIAL_SIZE,
-                                              Prms.N_BINS,
-                                              Prms.X_START[Prms.MID])
-        
-        # Near field
-        out_img, box_list_near = dip.find_cars(image,
-                                               Prms.Y_START[Prms.NEAR],
-                                               Prms.Y_STOP[Prms.NEAR],
-                                               Prms.SCALE[Prms.NEAR],
-                                               svc, X_scaler,
-                                               Prms.HOG_CHANNEL,
-                                               Prms.ORIENT,
-                                               Prms.PIX_PER_CELL,
-                                               Prms.CELL_PER_BLOCK,
-                                               Prms.SPATIAL_SIZE,
-                                               Prms.N_BINS,
-                                               Prms.X_START[Prms.NEAR])
-        
-        # Append the local and global box list
-        box_list = box_list_far + box_list_mid + box_list_near
-        Pipelines.frame_group_box_list += box_list
-
-        # Add heat to each box in box list
-        heat = dip.add_heat(heat, Pipelines.last_full_box_list)
-
-        # Apply threshold to help remove false positives
-        heat = dip.apply_threshold(heat, Prms.VIDEO_THRESHOLD)
-
-        # Visualize the heatmap when displaying
-        heatmap = np.clip(heat, 0, 255)
-
-        # Find final boxes from heatmap using label function
-        labels = label(heatmap)
-        draw_img = dip.draw_labeled_bboxes(np.copy(image), labels)
+        # The classifier and the scaler are loaded once by the default session
+        if Pipelines.detector is None:
+            Pipelines.detector = Detector()
 
         # Return the image with the detected vehicles
-        return draw_img
+        return Pipelines.detector.process_frame(image)
+
+    #------------------------
+    # Parallel video pipeline
+    #------------------------
+
+    def _init_worker(telemetry_enabled):
+        '''Load the model once in each worker process'''
+        Pipelines.detector = Detector(telemetry=Telemetry(enabled=telemetry_enabled, keep=False))
+
+    def _detect_frame(image):
+        '''
+        Search a frame for vehicles in a worker process and return the
+        detections along with the telemetry record of the search
+        '''
+
+        telemetry = Pipelines.detector.telemetry
+        telemetry.begin_frame(0)
+        box_list, timings = Pipelines.detector.detect(image)
+        return box_list, timings, telemetry.end_frame()
+
+    def video_parallel(video_in, video_out, workers, subclip=None, telemetry=NULL_TELEMETRY,
+                       watch=False, detections=None):
+        '''
+        Runs the video pipeline with the frame search spread over a pool of
+        worker processes. Frames are decoded in order, searched in parallel
+        and then fused, drawn and encoded in order again, so that the rolling
+        heat of the last frames sees the same frames as the serial pipeline.
+        With a detections file the frames are not drawn nor encoded and the
+        detection record of each frame is written instead
+        '''
+
+        # Decode stage, the frames in flight must keep their own buffers
+        reader = FrameReader(video_in, subclip=subclip, watch=watch)
+
+        # The session of the main process only keeps the frame book-keeping
+        detector = Detector(telemetry=telemetry)
+        if detections is not None:
+            writer = DetectionWriter(detections)
+        else:
+            writer = FrameWriter(video_out, reader.fps)
+
+        # Keep a bounded number of frames in flight so that decoding
+        # does not run ahead of the workers
+        max_in_flight = 2 * workers
+        in_flight = deque()
+        frames = 0
+        t = time.time()
+
+        def fuse_next():
+            '''Fuse and encode the oldest frame in flight'''
+            image, result = in_flight.popleft()
+            box_list, timings, record = result.get()
+            telemetry.begin_frame(detector.frames_total)
+            telemetry.merge(record)
+            detector.add_timings(timings)
+            if detections is not None:
+                writer.write(detector.detections(image.shape, box_list, timings))
+            else:
+                writer.write(detector.fuse(image, box_list))
+            telemetry.end_frame()
+
+        pool = multiprocessing.Pool(workers, initializer=Pipelines._init_worker,
+                                    initargs=(telemetry.enabled,))
+        try:
+            for image in reader:
+                # Search stage
+                in_flight.append((image, pool.apply_async(Pipelines._detect_frame, (image,))))
+                frames += 1
+
+                # Fuse and encode stage, in the order of the frames
+                if len(in_flight) >= max_in_flight:
+                    fuse_next()
+
+            # Drain the frames still in flight
+            while len(in_flight) > 0:
+                fuse_next()
+        finally:
+            pool.close()
+            pool.join()
+            reader.close()
+            writer.close()
+
+        # Report the throughput of the whole pipeline
+        elapsed = time.time() - t
+        print('>>> Processed', frames, 'frames with', workers, 'workers in',
+              round(elapsed, 2), 'seconds:', round(frames / max(elapsed, 1e-9), 2), 'frames per second')
+        detector.report()
+
+    #------------------------
+    # Batch image pipeline
+    #------------------------
+
+    def _locate_batch_image(image):
+        '''
+        Locate the vehicles of an image with the model of the default session
+        of the process. Returns None for an image that cannot be searched, e.g.
+        one that is too small for the search areas of Prms
+        '''
+
+        if Pipelines.detector is None:
+            Pipelines.detector = Detector()
+        detector = Pipelines.detector
+        try:
+            bboxes, heatmap, hits = Pipelines.locate_image(image, detector.model, None,
+                                                           detector.first_stage)
+        except cv2.error:
+            return None
+        return bboxes, hits
+
+    def image_batch(paths, workers=1, output_dir=None, detections=None, threads=2):
+        '''
+        Runs the heatmap pipeline of the test images headless on a list of
+        images of any length. The images are decoded ahead on background
+        threads and located on a pool of worker processes, a bounded number of
+        images at a time, then written in order: annotated with the vehicle
+        boxes to output_dir under their name and/or as a detection record per
+        image to the detections file. The images that cannot be read or
+        searched are skipped and reported
+        '''
+
+        reader = ImageReader(paths, threads=threads, read_ahead=4 * workers)
+        writer = DetectionWriter(detections) if detections is not None else None
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Images that are read but cannot be searched
+        unsearchable = []
+
+        def write(path, image, result):
+            '''Write the detections of an image'''
+            if result is None:
+                unsearchable.append(path)
+                return
+            bboxes, hits = result
+            if writer is not None:
+                record = OrderedDict()
+                record['image'] = path
+                record['boxes'] = [[x1, y1, x2, y2] for (x1, y1), (x2, y2) in bboxes]
+                record['hits'] = hits
+                writer.write(record)
+            if output_dir is not None:
+                draw_img = dip.draw_boxes(image, bboxes, Prms.LINE_COLOR, Prms.LINE_THICKNESS)
+                cv2.imwrite(os.path.join(output_dir, os.path.basename(path)),
+                            cv2.cvtColor(draw_img, cv2.COLOR_RGB2BGR))
+
+        images = 0
+        t = time.time()
+        pool = None
+        try:
+            if workers > 1:
+                # Keep a bounded number of images in flight on the workers
+                pool = multiprocessing.Pool(workers)
+                in_flight = deque()
+                for path, image in reader:
+                    in_flight.append((path, image,
+                                      pool.apply_async(Pipelines._locate_batch_image, (image,))))
+                    if len(in_flight) >= 2 * workers:
+                        path, image, result = in_flight.popleft()
+                        write(path, image, result.get())
+                        images += 1
+
+                # Drain the images still in flight
+                while len(in_flight) > 0:
+                    path, image, result = in_flight.popleft()
+                    write(path, image, result.get())
+                    images += 1
+            else:
+                for path, image in reader:
+                    write(path, image, Pipelines._locate_batch_image(image))
+                    images += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if writer is not None:
+                writer.close()
+
+        # Report the throughput of the whole pipeline over the searched images
+        elapsed = time.time() - t
+        images -= len(unsearchable)
+        print('>>> Processed', images, 'images with', workers, 'workers in',
+              round(elapsed, 2), 'seconds:', round(images / max(elapsed, 1e-9), 2), 'images per second')
+        if len(reader.skipped) > 0:
+            print('>>> Skipped', len(reader.skipped), 'images that could not be read')
+        if len(unsearchable) > 0:
+            print('>>> Skipped', len(unsearchable), 'images that could not be searched:',
+                  ', '.join(unsearchable))
@@ -0,0 +1,249 @@
+
+import csv
+import cv2
+import glob
+import json
+import numpy as np
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class FrameReader:
+    '''
+    Streams the RGB frames of a video file, a camera, a named pipe or a
+    directory of images one at a time, so that the memory footprint does
+    not depend on the length of the stream. A watched directory never ends:
+    new images are picked up in name order as they appear. With reuse the
+    frames are decoded into the same buffers, so a frame is only valid until
+    the next one is read
+    '''
+
+    def __init__(self, source, subclip=None, watch=False, poll=0.5, reuse=False, fps=25.):
+        self.source = source
+        self.watch = watch
+        self.poll = poll
+        self.reuse = reuse
+        self.capture = None
+
+        # The frame rate is given by the video, images are played at fps
+        self.fps = fps
+        if not os.path.isdir(source):
+            self.capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+            if not self.capture.isOpened():
+                raise IOError('Cannot open the video source: {}'.format(source))
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or fps
+
+        # Subclip in seconds as frame indices
+        self.start = 0
+        self.stop = None
+        if subclip is not None:
+            self.start = int(round(subclip[0] * self.fps))
+            self.stop = int(round(subclip[1] * self.fps))
+
+    def _video_frames(self):
+        '''Yields the BGR frames of the video capture'''
+
+        image = None
+        while True:
+            ok, image = self.capture.read(image if self.reuse else None)
+            if not ok:
+                return
+            yield image
+
+    def _image_paths(self):
+        '''Yields the images of the directory in name order, waiting for new ones when watched'''
+
+        last = None
+        while True:
+            paths = sorted(path for path in glob.glob(os.path.join(self.source, '*'))
+                           if path.lower().endswith(IMAGE_EXTENSIONS))
+            new_paths = [path for path in paths if last is None or path > last]
+            for path in new_paths:
+                last = path
+                yield path
+            if not self.watch:
+                return
+            if len(new_paths) == 0:
+                time.sleep(self.poll)
+
+    def _image_frames(self):
+        '''Yields the BGR frames of the images of the directory'''
+
+        for path in self._image_paths():
+            image = cv2.imread(path)
+
+            # An image that is still being written is read again on the next poll
+            while image is None and self.watch:
+                time.sleep(self.poll)
+                image = cv2.imread(path)
+            if image is not None:
+                yield image
+
+    def __iter__(self):
+        frames = self._image_frames() if self.capture is None else self._video_frames()
+        rgb = None
+        for n, image in enumerate(frames):
+            if n < self.start:
+                continue
+            if self.stop is not None and n >= self.stop:
+                break
+
+            # Convert to RGB in place of the previous frame when reusing the buffers
+            if not self.reuse or rgb is None or rgb.shape != image.shape:
+                rgb = np.empty_like(image)
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=rgb)
+            yield rgb
+        self.close()
+
+    def close(self):
+        '''Release the video capture'''
+
+        if self.capture is not None:
+            self.capture.release()
+
+def image_paths(sources):
+    '''
+    Returns the image paths of a list of sources in order: the images of a
+    directory in name order, the paths listed one per line in a .txt file,
+    relative to the list, or the path of an image
+    '''
+
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(sorted(path for path in glob.glob(os.path.join(source, '*'))
+                                if path.lower().endswith(IMAGE_EXTENSIONS)))
+        elif source.lower().endswith('.txt'):
+            with open(source) as f:
+                paths.extend(os.path.join(os.path.dirname(source), line.strip())
+                             for line in f if line.strip())
+        else:
+            paths.append(source)
+    return paths
+
+class ImageReader:
+    '''
+    Reads a list of images ahead of their use and decodes them on a pool of
+    background threads, as OpenCV releases the GIL while decoding, so that
+    the decoding overlaps the detection. At most read_ahead images are held
+    in memory. Yields (path, RGB image) pairs in the order of the list, the
+    images that cannot be read are skipped and kept in skipped
+    '''
+
+    def __init__(self, paths, threads=2, read_ahead=8):
+        self.paths = paths
+        self.threads = threads
+        self.read_ahead = max(read_ahead, 1)
+        self.skipped = []
+
+    def _read(path):
+        '''Returns the RGB image of a path or None'''
+
+        image = cv2.imread(path)
+        if image is None:
+            return None
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def __iter__(self):
+        paths = iter(self.paths)
+        with ThreadPoolExecutor(self.threads) as executor:
+            # Keep the next images decoding while the current one is used
+            pending = deque()
+            for path in paths:
+                pending.append((path, executor.submit(ImageReader._read, path)))
+                if len(pending) == self.read_ahead:
+                    break
+
+            while len(pending) > 0:
+                path, image = pending.popleft()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending.append((next_path, executor.submit(ImageReader._read, next_path)))
+
+                image = image.result()
+                if image is None:
+                    self.skipped.append(path)
+                    continue
+                yield path, image
+
+class FrameWriter:
+    '''
+    Writes RGB frames to a video file, or to numbered images when the output
+    has no extension, converting each frame into a preallocated BGR buffer.
+    The video writer is opened with the size of the first frame
+    '''
+
+    def __init__(self, path, fps=25., fourcc='mp4v'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.writer = None
+        self.buffer = None
+        self.frames = 0
+        self.directory = os.path.splitext(path)[1] == ''
+        if self.directory:
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, frame):
+        '''Write the next RGB frame'''
+
+        if self.buffer is None or self.buffer.shape != frame.shape:
+            self.buffer = np.empty_like(frame)
+        cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.buffer)
+
+        if self.directory:
+            cv2.imwrite(os.path.join(self.path, 'frame_{:06d}.png'.format(self.frames)), self.buffer)
+        else:
+            if self.writer is None:
+                height, width = frame.shape[:2]
+                self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc),
+                                              self.fps, (width, height))
+            self.writer.write(self.buffer)
+        self.frames += 1
+
+    def close(self):
+        '''Finish the video file'''
+
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+class DetectionWriter:
+    '''
+    Writes the detection record of each frame instead of the rendered frame,
+    one JSON object per line or one CSV row per frame depending on the
+    extension. The CSV columns are given by the first record and the boxes
+    are written as a JSON list. Each record is flushed as a line so that the
+    output can be followed while a long-lived stream is running
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.csv = path.endswith('.csv')
+        self.frames = 0
+        self._sink = open(path, 'w', newline='', buffering=1)
+        self._writer = None
+
+    def write(self, record):
+        '''Write the detection record of the next frame'''
+
+        if not self.csv:
+            self._sink.write(json.dumps(record) + '\n')
+        else:
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._sink, fieldnames=list(record.keys()))
+                self._writer.writeheader()
+            row = dict(record)
+            row['boxes'] = json.dumps(record['boxes'])
+            self._writer.writerow(row)
+        self.frames += 1
+
+    def close(self):
+        '''Close the output file'''
+
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
@@ -0,0 +1,161 @@
+
+import csv
+import json
+import time
+from collections import OrderedDict
+
+from parameters import Prms
+
+class _Stage:
+    '''Context manager that adds the duration of a stage to the current frame'''
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.add_time(self.name, time.perf_counter() - self.t)
+        return False
+
+class _NullStage:
+    '''Context manager that does nothing, shared by all the disabled stages'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+# Columns of the CSV sink: every stage and counter a frame may record, so
+# that the counters of the frames that only some of the frames have, e.g.
+# the regions of interest of the tracked frames, get a column of their own
+CSV_COLUMNS = ['frame',
+               'convert_ms', 'resize_ms', 'cascade_ms', 'hog_ms', 'features_ms', 'predict_ms',
+               'heatmap_ms', 'label_ms', 'draw_ms',
+               'windows', 'rejected', 'hits'] + \
+              ['hits_scale_{}'.format(scale) for scale in Prms.SCALE] + ['rois', 'vehicles']
+
+class Telemetry:
+    '''
+    Frame-level telemetry of the detection pipeline. Records the duration of
+    each stage and counters such as the number of windows and hits for every
+    frame. The records are kept in memory and optionally written to a CSV or
+    JSONL sink. When disabled, stages and counters are no-ops
+    '''
+
+    def __init__(self, enabled=True, sink=None, keep=True):
+        self.enabled = enabled
+        self.keep = keep
+        self.frames = [] # Records of the processed frames
+        self.session = OrderedDict() # Stages outside of the frames, e.g. the model load
+        self.current = None
+
+        # Open the sink, the format is given by the extension
+        self._sink = None
+        self._writer = None
+        if enabled and sink:
+            self._sink = open(sink, 'w', newline='')
+            self._csv = sink.endswith('.csv')
+
+    def begin_frame(self, frame_n):
+        '''Start the record of a frame'''
+
+        if self.enabled:
+            self.current = OrderedDict([('frame', frame_n)])
+
+    def stage(self, name):
+        '''Returns a context manager that times a stage of the current frame'''
+
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        '''Add the duration of a stage in seconds to the current frame'''
+
+        if not self.enabled:
+            return
+        key = name + '_ms'
+        record = self.current if self.current is not None else self.session
+        record[key] = record.get(key, 0.) + 1000 * seconds
+
+    def count(self, name, value):
+        '''Add to a counter of the current frame'''
+
+        if self.enabled and self.current is not None:
+            self.current[name] = self.current.get(name, 0) + value
+
+    def merge(self, record):
+        '''Add the stages and counters of a record, e.g. from a worker process, to the current frame'''
+
+        if not self.enabled or self.current is None or record is None:
+            return
+        for key, value in record.items():
+            if key != 'frame':
+                self.current[key] = self.current.get(key, 0) + value
+
+    def end_frame(self):
+        '''Close the record of the current frame, write it to the sink and return it'''
+
+        if not self.enabled or self.current is None:
+            return None
+        record, self.current = self.current, None
+        if self.keep:
+            self.frames.append(record)
+        if self._sink is not None:
+            self._write(record)
+        return record
+
+    def _write(self, record):
+        '''Write a record to the sink'''
+
+        if not self._csv:
+            self._sink.write(json.dumps(record) + '\n')
+            return
+
+        # The columns of the CSV are declared up front, a stage or counter
+        # without a column raises instead of being dropped
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._sink, fieldnames=CSV_COLUMNS, restval=0)
+            self._writer.writeheader()
+        self._writer.writerow(record)
+
+    def summary(self):
+        '''Returns the mean of each stage and counter per frame'''
+
+        totals = OrderedDict()
+        for record in self.frames:
+            for key, value in record.items():
+                if key != 'frame':
+                    totals[key] = totals.get(key, 0) + value
+        n = max(len(self.frames), 1)
+        return OrderedDict((key, value / n) for key, value in totals.items())
+
+    def print_summary(self):
+        '''Print the mean of each stage and counter per frame'''
+
+        if not self.enabled:
+            return
+        if len(self.session) > 0:
+            print('>>> Telemetry of the session:')
+            for key, value in self.session.items():
+                print('    {:<20} {:10.2f}'.format(key, value))
+        print('>>> Telemetry over', len(self.frames), 'frames, mean per frame:')
+        for key, value in self.summary().items():
+            print('    {:<20} {:10.2f}'.format(key, value))
+
+    def close(self):
+        '''Close the sink'''
+
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+# Shared disabled telemetry for the callers that do not record anything
+NULL_TELEMETRY = Telemetry(enabled=False)
@@ -0,0 +1,82 @@
+
+from dip import dip
+from parameters import Prms
+
+import numpy as np
+
+class TemporalHeat:
+    '''
+    Rolling heat of the last frames of a stream. The heat of each frame is
+    kept in a fixed-size ring buffer over the searched rows and a running sum
+    is updated with the newest frame and the frame that leaves the window, so
+    every frame costs the same whatever the size of the window. With a decay
+    below 1 the heat of a frame k frames old is weighted by decay**k
+    '''
+
+    def __init__(self, window=Prms.HEAT_WINDOW, decay=Prms.HEAT_DECAY, y_range=None):
+        if window < 1:
+            raise ValueError('The heat window must be at least one frame')
+        if not 0 < decay <= 1:
+            raise ValueError('The heat decay must be in (0, 1]')
+
+        self.window = window
+        self.decay = decay
+        self.y_range = y_range
+        self.reset()
+
+    def reset(self):
+        '''Forget the heat of the previous frames'''
+
+        self.shape = None
+        self.frames = None # Ring buffer of the heat of the last frames
+        self.heat = None # Running sum of the heat in the ring buffer
+        self.index = 0 # Slot of the oldest frame in the ring buffer
+
+    def _allocate(self, shape):
+        '''Allocate the ring buffer and the running sum for the frame shape'''
+
+        y_top, y_bottom = dip.heat_band(shape, self.y_range)
+        band = (y_bottom - y_top, shape[1])
+        self.shape = shape[:2]
+        self.frames = np.zeros((self.window,) + band, dtype=np.uint16)
+
+        # The running sum stays exact in integers unless the frames are decayed
+        self.heat = np.zeros(band, dtype=np.int32 if self.decay == 1 else np.float32)
+        self.index = 0
+
+    def update(self, shape, bbox_list):
+        '''Add the box list of the next frame of the stream to the rolling heat'''
+
+        if self.shape != shape[:2]:
+            self._allocate(shape)
+
+        # The frame in the slot of the oldest one leaves the window
+        oldest = self.frames[self.index]
+        if self.decay == 1:
+            self.heat -= oldest
+        else:
+            self.heat *= self.decay
+            self.heat -= self.decay**self.window * oldest.astype(np.float32)
+
+        # Store the heat of the new frame in its place and add it to the sum
+        heat = dip.box_heat(shape, bbox_list, self.y_range)
+        np.minimum(heat, np.iinfo(np.uint16).max, out=oldest, casting='unsafe')
+        self.heat += oldest
+        self.index = (self.index + 1) % self.window
+
+    def peak(self):
+        '''Returns the highest heat of the frames in the window'''
+
+        if self.heat is None or self.heat.size == 0:
+            return 0.
+        return round(float(self.heat.max()), 3)
+
+    def heatmap(self, threshold=0):
+        '''Returns the thresholded heatmap of the frames in the window'''
+
+        heat = self.heat
+        if self.decay != 1:
+            # Round off the drift of the running sum so that the heat compares
+            # against the threshold like the sum of the decayed frames would
+            heat = np.round(heat, 3)
+        return dip.threshold_heat(self.shape, heat, threshold, self.y_range)
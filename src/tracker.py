@@ -0,0 +1,108 @@
+
+from parameters import Prms
+
+import numpy as np
+
+class Track:
+    '''A detected vehicle with its box (x1, y1, x2, y2) and the velocity of its center'''
+
+    def __init__(self, box):
+        self.box = np.asarray(box, dtype=np.float64)
+        self.velocity = np.zeros(2)
+
+    def center(self):
+        return (self.box[:2] + self.box[2:]) / 2
+
+    def predict(self):
+        '''Returns the box moved by one frame of the constant velocity model'''
+
+        return self.box + np.tile(self.velocity, 2)
+
+    def update(self, box, smoothing):
+        '''Move the track to the box of the new frame and smooth its velocity'''
+
+        box = np.asarray(box, dtype=np.float64)
+        shift = (box[:2] + box[2:]) / 2 - self.center()
+        self.velocity = smoothing * self.velocity + (1 - smoothing) * shift
+        self.box = box
+
+class Tracker:
+    '''
+    Tracks the vehicles of a stream between the full searches of the frame.
+    The vehicles of each frame are matched to the tracks of the previous one
+    by the overlap of their boxes and every track moves with a constant
+    velocity, so that the next frame only has to be searched in padded
+    regions of interest around the predicted boxes
+    '''
+
+    def __init__(self, pad=Prms.TRACK_PAD, smoothing=0.5):
+        self.pad = pad
+        self.smoothing = smoothing
+        self.tracks = []
+
+    def reset(self):
+        '''Forget all the tracks'''
+        self.tracks = []
+
+    def _overlap(box, other):
+        '''Returns the intersection over union of two (x1, y1, x2, y2) boxes'''
+
+        w = min(box[2], other[2]) - max(box[0], other[0])
+        h = min(box[3], other[3]) - max(box[1], other[1])
+        if w <= 0 or h <= 0:
+            return 0.
+        area = lambda b: (b[2] - b[0]) * (b[3] - b[1])
+        return w * h / (area(box) + area(other) - w * h)
+
+    def update(self, bboxes):
+        '''
+        Update the tracks with the vehicle boxes ((x1, y1), (x2, y2)) of the
+        new frame. A box matches the unmatched track it overlaps the most after
+        the prediction, the tracks without a box are dropped and the boxes
+        without a track start a new one
+        '''
+
+        tracks = []
+        unmatched = list(self.tracks)
+        for bbox in bboxes:
+            box = (bbox[0][0], bbox[0][1], bbox[1][0], bbox[1][1])
+            overlaps = [Tracker._overlap(box, track.predict()) for track in unmatched]
+            if len(overlaps) > 0 and max(overlaps) > 0:
+                track = unmatched.pop(int(np.argmax(overlaps)))
+                track.update(box, self.smoothing)
+            else:
+                track = Track(box)
+            tracks.append(track)
+        self.tracks = tracks
+
+    def rois(self, shape):
+        '''
+        Returns the regions of interest (x1, y1, x2, y2) of the next frame: the
+        predicted box of each track padded on all sides by a fraction of its
+        size, clipped to the frame and with the overlapping regions merged
+        so that no window is searched twice
+        '''
+
+        rois = []
+        for track in self.tracks:
+            box = track.predict()
+            pad = self.pad * (box[2:] - box[:2])
+            rois.append([int(max(box[0] - pad[0], 0)), int(max(box[1] - pad[1], 0)),
+                         int(min(box[2] + pad[0], shape[1])), int(min(box[3] + pad[1], shape[0]))])
+
+        # Merge the overlapping regions until none of them overlap
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rois)):
+                for j in range(i + 1, len(rois)):
+                    a, b = rois[i], rois[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del rois[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return [tuple(roi) for roi in rois if roi[2] > roi[0] and roi[3] > roi[1]]